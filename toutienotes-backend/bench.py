@@ -0,0 +1,278 @@
+"""
+Benchmark de montée en charge de ToutieNote.
+
+Génère un jeu de données synthétique (notes avec tags et wikilinks, pièces jointes,
+albums de photos dont des quasi-doublons), puis pilote l'application en processus via
+son API HTTP et mesure p50/p95/p99 des opérations courantes. Résultat écrit en JSON
+pour comparer deux versions:
+
+    python bench.py --notes 100000 --photos 2000 --out avant.json
+    python bench.py --notes 100000 --photos 2000 --out apres.json --compare avant.json
+
+Les données vont dans un répertoire temporaire (TOUTIENOTES_DATA_DIR), jamais dans DATA_DIR.
+"""
+import argparse, asyncio, io, json, os, platform, random, shutil, subprocess, sys, tempfile, time
+from datetime import datetime
+from pathlib import Path
+
+WORDS = (
+    "projet réunion idée liste courses recette voyage budget lecture film jardin travail "
+    "sport musique famille santé planning rappel brouillon archive code serveur photo album "
+    "note tâche semaine mois objectif bilan article cuisine maison vélo montagne plage"
+).split()
+TAGS = ["perso", "travail", "idée", "urgent", "lecture", "recette", "voyage", "todo", "archive", "santé"]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def summarize(samples_ms):
+    values = sorted(samples_ms)
+    return {
+        "n": len(values),
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "mean_ms": round(sum(values) / len(values), 3),
+        "max_ms": round(values[-1], 3),
+    }
+
+class Bench:
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        self.samples = {}
+        self.headers = {}
+
+    def call(self, name, method, url, **kwargs):
+        started = time.perf_counter()
+        response = self.client.request(method, url, headers=self.headers, **kwargs)
+        elapsed = (time.perf_counter() - started) * 1000
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {url}: {response.status_code} {response.text[:200]}")
+        if name:
+            self.samples.setdefault(name, []).append(elapsed)
+        return response
+
+    # ── Jeu de données ───────────────────────────────────────────────────────
+    def note_content(self, titles):
+        words = self.rng.choices(WORDS, k=self.rng.randint(30, 300))
+        for _ in range(self.rng.randint(0, 3)):
+            words.insert(self.rng.randrange(len(words)), f"#{self.rng.choice(TAGS)}")
+        for _ in range(self.rng.randint(0, 4)):
+            words.insert(self.rng.randrange(len(words)), f"[[{self.rng.choice(titles)}]]")
+        return " ".join(words)
+
+    def generate_notes(self, count):
+        titles = [f"{self.rng.choice(WORDS).capitalize()} {i}" for i in range(count)]
+        ids = []
+        for start in range(0, count, 1000):
+            ops = [
+                {"op": "create", "title": title, "content": self.note_content(titles)}
+                for title in titles[start:start + 1000]
+            ]
+            results = self.call(None, "POST", "/api/notes/batch", json={"ops": ops}).json()["results"]
+            ids.extend(r["id"] for r in results)
+        return ids, titles
+
+    def generate_attachments(self, note_ids, count):
+        for note_id in self.rng.sample(note_ids, min(count, len(note_ids))):
+            data = os.urandom(self.rng.randint(1_000, 50_000))
+            self.call(None, "POST", f"/api/notes/{note_id}/attachments",
+                      files={"file": ("piece.bin", data, "application/octet-stream")})
+
+    def base_image(self):
+        import numpy as np
+        from PIL import Image, ImageDraw
+        # Image douce (bruit basse résolution agrandi) + formes: pHash significatif
+        seed = self.rng.randrange(2**32)
+        low = np.random.default_rng(seed).integers(0, 255, (6, 8, 3), dtype=np.uint8)
+        img = Image.fromarray(low).resize((320, 240), Image.BICUBIC)
+        draw = ImageDraw.Draw(img)
+        for _ in range(4):
+            x, y = self.rng.randrange(280), self.rng.randrange(200)
+            draw.ellipse((x, y, x + self.rng.randint(20, 90), y + self.rng.randint(20, 90)),
+                         fill=tuple(self.rng.randrange(256) for _ in range(3)))
+        return img
+
+    def near_duplicate(self, img):
+        from PIL import ImageEnhance
+        kind = self.rng.choice(("resize", "crop", "jpeg", "light"))
+        if kind == "resize":
+            return img.resize((img.width * 3 // 4, img.height * 3 // 4))
+        if kind == "crop":
+            dx, dy = img.width // 10, img.height // 10
+            return img.crop((dx, dy, img.width - dx, img.height - dy))
+        if kind == "light":
+            return ImageEnhance.Brightness(img).enhance(1.15)
+        return img
+
+    def generate_photos(self, count, albums, dup_ratio):
+        album_ids = [
+            self.call(None, "POST", "/api/vault/albums", json={"name": f"Album {i}"}).json()["id"]
+            for i in range(albums)
+        ]
+        bases = []
+        for i in range(count):
+            if bases and self.rng.random() < dup_ratio:
+                img = self.near_duplicate(self.rng.choice(bases))
+            else:
+                img = self.base_image()
+                bases.append(img)
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=self.rng.choice((70, 85, 95)))
+            params = {"album_id": album_ids[i % len(album_ids)]} if album_ids else {}
+            self.call("upload", "POST", "/api/vault/upload", params=params,
+                      files={"file": (f"photo_{i}.jpg", buf.getvalue(), "image/jpeg")})
+        return album_ids
+
+    # ── Mesures ──────────────────────────────────────────────────────────────
+    def measure(self, note_ids, titles, album_ids, iterations, scan_runs):
+        for _ in range(iterations):
+            self.call("list_page", "GET", "/api/notes", params={"limit": 100})
+            word = self.rng.choice(WORDS)
+            self.call("search", "GET", "/api/notes/search", params={"q": f"{word} {self.rng.choice(WORDS)[:3]}"})
+            self.call("backlinks", "GET", f"/api/notes/{self.rng.choice(note_ids)}/backlinks")
+            self.call("by_title", "GET", "/api/notes/by-title", params={"title": self.rng.choice(titles)})
+            self.call("get_note", "GET", f"/api/notes/{self.rng.choice(note_ids)}")
+            if album_ids:
+                self.call("list_photos_album", "GET", "/api/vault/photos", params={"album_id": self.rng.choice(album_ids)})
+        for _ in range(max(1, iterations // 20)):
+            self.call("list_all", "GET", "/api/notes")
+            self.call("list_photos", "GET", "/api/vault/photos")
+        for _ in range(scan_runs):
+            self.call("duplicate_scan", "POST", "/api/vault/scan-duplicates-sync")
+
+    # ── Lectures pendant des uploads concurrents ────────────────────────────
+    def measure_reads_during_uploads(self, app, note_ids, uploads, seconds=1.0):
+        """
+        Lectures de notes au repos puis pendant `uploads` envois de grandes photos en parallèle
+        (client ASGI asynchrone: le TestClient sérialise les requêtes). Le décodage des images
+        ne doit pas bloquer l'event loop: get_note_during_uploads reste proche de get_note_idle.
+        """
+        import httpx
+        payloads = []
+        for _ in range(uploads):
+            buf = io.BytesIO()
+            self.base_image().resize((3200, 2400)).save(buf, "JPEG", quality=90)
+            payloads.append(buf.getvalue())
+
+        async def reads(client, name, stop):
+            while not stop.is_set():
+                started = time.perf_counter()
+                response = await client.get(f"/api/notes/{self.rng.choice(note_ids)}", headers=self.headers)
+                response.raise_for_status()
+                self.samples.setdefault(name, []).append((time.perf_counter() - started) * 1000)
+                await asyncio.sleep(0.005)
+
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+                stop = asyncio.Event()
+                task = asyncio.create_task(reads(client, "get_note_idle", stop))
+                await asyncio.sleep(seconds)
+                stop.set()
+                await task
+                stop = asyncio.Event()
+                task = asyncio.create_task(reads(client, "get_note_during_uploads", stop))
+                responses = await asyncio.gather(*[
+                    client.post("/api/vault/upload", headers=self.headers,
+                                files={"file": (f"grande_{i}.jpg", data, "image/jpeg")})
+                    for i, data in enumerate(payloads)
+                ])
+                stop.set()
+                await task
+                for response in responses:
+                    response.raise_for_status()
+
+        asyncio.run(run())
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def print_results(results, previous=None):
+    print(f"{'opération':<26}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}" + ("   p50 vs réf." if previous else ""))
+    for name, stats in results.items():
+        line = f"{name:<26}{stats['n']:>6}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+        before = (previous or {}).get(name)
+        if before and before["p50_ms"]:
+            line += f"   x{stats['p50_ms'] / before['p50_ms']:.2f}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ToutieNote sur jeu de données synthétique")
+    parser.add_argument("--notes", type=int, default=5000)
+    parser.add_argument("--attachments", type=int, default=200)
+    parser.add_argument("--photos", type=int, default=300)
+    parser.add_argument("--albums", type=int, default=10)
+    parser.add_argument("--dup-ratio", type=float, default=0.2, help="part des photos quasi-doublons d'une autre")
+    parser.add_argument("--iterations", type=int, default=200, help="répétitions par opération mesurée")
+    parser.add_argument("--scan-runs", type=int, default=1)
+    parser.add_argument("--concurrent-uploads", type=int, default=8,
+                        help="grandes photos envoyées en parallèle pendant les lectures (0: désactivé)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", help="répertoire de données conservé (défaut: temporaire, supprimé)")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="résultat JSON de référence à comparer")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="toutienotes-bench-")
+    os.environ["TOUTIENOTES_DATA_DIR"] = data_dir
+    os.environ.pop("TOUTIENOTES_LOCAL_DB", None)
+    sys.path.insert(0, str(Path(__file__).parent))
+    import_started = time.perf_counter()
+    import main as app_module
+    from fastapi.testclient import TestClient
+    import_seconds = time.perf_counter() - import_started
+
+    rng = random.Random(args.seed)
+    setup = {"import": round(import_seconds, 3)}
+    with TestClient(app_module.app) as client:
+        bench = Bench(client, rng)
+        token = bench.call(None, "POST", "/api/auth/register",
+                           json={"username": "bench", "password": "bench-password"}).json()["token"]
+        bench.headers = {"Authorization": f"Bearer {token}"}
+
+        started = time.perf_counter()
+        note_ids, titles = bench.generate_notes(args.notes)
+        setup["notes"] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        bench.generate_attachments(note_ids, args.attachments)
+        setup["attachments"] = round(time.perf_counter() - started, 3)
+        started = time.perf_counter()
+        album_ids = bench.generate_photos(args.photos, args.albums, args.dup_ratio)
+        setup["photos"] = round(time.perf_counter() - started, 3)
+        print(f"Jeu de données prêt dans {data_dir}: {setup}", flush=True)
+
+        bench.measure(note_ids, titles, album_ids, args.iterations, args.scan_runs)
+        if args.concurrent_uploads:
+            bench.measure_reads_during_uploads(app_module.app, note_ids, args.concurrent_uploads)
+    if not args.data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    results = {name: summarize(samples) for name, samples in bench.samples.items()}
+    report = {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "dataset": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "data_dir")},
+        "setup_seconds": setup,
+        "results": results,
+    }
+    Path(args.out).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    previous = json.loads(Path(args.compare).read_text())["results"] if args.compare else None
+    print_results(results, previous)
+    print(f"Résultats écrits dans {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,76 @@
+import time
+_BOOT_STARTED = time.perf_counter()
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import sqlite3, os, shutil, hashlib, uuid, json, threading, re
-from datetime import datetime
+import sqlite3, os, shutil, hashlib, uuid, json, threading, re, base64, zlib, difflib, asyncio, random
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from datetime import datetime, timedelta
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from collections import OrderedDict, deque
 from pathlib import Path
-from PIL import Image
-try:
-    import imagehash
-except ImportError:
-    imagehash = None
-try:
-    import numpy as np
-except ImportError:
-    np = None
-import io, sys
-from urllib.parse import quote
+import io, sys, socket, fcntl, importlib, html
+from urllib.parse import unquote_plus
+
+# ── Démarrage: imports lourds à la demande ────────────────────────────────────
+# PIL, imagehash et numpy ne servent qu'au coffre photo: chargés au premier usage (ou par le
+# préchauffage en arrière-plan), l'API des notes répond sans les attendre.
+startup_report = {"imports_ms": round((time.perf_counter() - _BOOT_STARTED) * 1000, 1),
+                  "init_db_ms": None, "ready_ms": None, "lazy_imports_ms": {}, "warmup_ms": None}
+
+class LazyModule:
+    """Module importé au premier accès d'attribut. Faux (bool) s'il n'est pas installé."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._missing = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None and not self._missing:
+            with self._lock:
+                if self._module is None and not self._missing:
+                    started = time.perf_counter()
+                    try:
+                        self._module = importlib.import_module(self._name)
+                    except ImportError:
+                        self._missing = True
+                    startup_report["lazy_imports_ms"][self._name] = round((time.perf_counter() - started) * 1000, 1)
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        if module is None:
+            raise ImportError(f"{self._name} non installé")
+        return getattr(module, attr)
+
+    def __bool__(self):
+        return self._load() is not None
+
+Image = LazyModule("PIL.Image")
+imagehash = LazyModule("imagehash")
+np = LazyModule("numpy")
+photo_hashing = LazyModule("photo_hashing")  # module voisin, importable par les workers du scan
+
+# Préchauffage après le démarrage (TOUTIENOTES_WARMUP=0 pour le désactiver): le premier upload
+# ou scan ne paie pas les imports. CLIP n'est jamais préchargé (dépendance optionnelle).
+WARMUP_ENABLED = os.environ.get("TOUTIENOTES_WARMUP", "1") == "1"
+
+def _warmup_imaging():
+    started = time.perf_counter()
+    try:
+        if imagehash:
+            imagehash.phash(Image.new("L", (64, 64)))
+    except Exception as e:
+        print(f"Erreur préchauffage imagerie: {e}", flush=True)
+    startup_report["warmup_ms"] = round((time.perf_counter() - started) * 1000, 1)
 
 app = FastAPI()
 
@@ -32,23 +86,575 @@ app.add_middleware(
 )
 
 # ── Paths ──────────────────────────────────────────────────────────────────────
-DATA_DIR   = Path("/mnt/Nextcloud/toutienotes")
+DATA_DIR   = Path(os.environ.get("TOUTIENOTES_DATA_DIR", "/mnt/Nextcloud/toutienotes"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
-DB_PATH    = DATA_DIR / "notes.db"
+# Mode base locale: si TOUTIENOTES_LOCAL_DB est défini, la base vive est sur disque local
+# et DATA_DIR/notes.db n'est plus qu'un snapshot (voir section DB snapshot)
+SNAPSHOT_PATH = DATA_DIR / "notes.db"
+LOCAL_DB_PATH = os.environ.get("TOUTIENOTES_LOCAL_DB")
+DB_PATH    = Path(LOCAL_DB_PATH) if LOCAL_DB_PATH else SNAPSHOT_PATH
+DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 VAULT_DIR  = DATA_DIR / "vault"
 VAULT_DIR.mkdir(parents=True, exist_ok=True)
 NOTE_ATTACHMENTS_DIR = DATA_DIR / "note_attachments"
 NOTE_ATTACHMENTS_DIR.mkdir(parents=True, exist_ok=True)
 
-# ── DB init ────────────────────────────────────────────────────────────────────
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# Nombre de workers uvicorn (uvicorn prend WEB_CONCURRENCY comme valeur par défaut de --workers).
+# Au-delà de 1, l'état partagé passe par SQLite: table jobs, autosave écrit directement, cache auth court.
+WORKERS = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+@contextmanager
+def file_lock(path: Path):
+    """Verrou exclusif inter-processus (flock), pour les étapes que les workers ne doivent pas faire ensemble."""
+    with open(path, "a") as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+# Contenus de notes au-delà de ce seuil (octets UTF-8) stockés compressés, marqués par content_codec
+NOTE_COMPRESS_THRESHOLD = 4096
+NOTE_CODEC = "zlib"
+
+def encode_note_content(content: str):
+    """Retourne (valeur stockée, codec). Ne compresse que si le gain est réel."""
+    raw = (content or "").encode("utf-8")
+    if len(raw) >= NOTE_COMPRESS_THRESHOLD:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            return packed, NOTE_CODEC
+    return content, None
+
+def decode_note_content(value, codec):
+    if codec == NOTE_CODEC and value is not None:
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+# ── Métriques (format texte Prometheus) ───────────────────────────────────────
+# Activées par TOUTIENOTES_METRICS=1. Désactivées, ni middleware, ni connexion instrumentée:
+# seuls restent des tests de booléen dans metric_timer/metric_inc.
+# Chaque worker uvicorn expose ses propres compteurs (label worker pour les distinguer).
+METRICS_ENABLED = os.environ.get("TOUTIENOTES_METRICS") == "1"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics_lock = threading.Lock()
+_metric_help = {}
+_counters = {}      # (nom, labels) -> valeur
+_gauges = {}
+_histograms = {}    # (nom, labels) -> [compteurs par bucket..., somme, total]
+
+# Statistiques SQL de la requête HTTP en cours (partagées avec le threadpool via le contexte)
+_request_sql = ContextVar("request_sql", default=None)
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def metric_inc(name: str, value: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def metric_gauge_add(name: str, delta: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+def metric_observe(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _metrics_lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+@contextmanager
+def _timed(name: str, labels: dict):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, time.perf_counter() - started, **labels)
+
+def metric_timer(name: str, **labels):
+    """with metric_timer("image_processing_seconds", op="phash"): ... — nullcontext si désactivé."""
+    return _timed(name, labels) if METRICS_ENABLED else nullcontext()
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra + (("worker", WORKER_ID),)
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def render_metrics() -> str:
+    with _metrics_lock:
+        counters, gauges = dict(_counters), dict(_gauges)
+        histograms = {key: list(hist) for key, hist in _histograms.items()}
+    lines = []
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        seen = set()
+        for (name, labels), value in sorted(series.items()):
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    seen = set()
+    for (name, labels), hist in sorted(histograms.items()):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, hist):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', f'{bound:g}'),))} {cumulative}")
+        lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {hist[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {hist[-2]:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {hist[-1]}")
+    return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """Middleware ASGI: compte, latence et requêtes SQL par route (gabarit de route, pas le chemin brut)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        status = 500
+        sql = {"queries": 0, "seconds": 0.0}
+        token = _request_sql.set(sql)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metric_gauge_add("http_requests_in_flight", 1, method=method)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_sql.reset(token)
+            metric_gauge_add("http_requests_in_flight", -1, method=method)
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "(sans route)"
+            metric_inc("http_requests_total", method=method, route=path, status=status)
+            metric_observe("http_request_duration_seconds", elapsed, method=method, route=path)
+            if sql["queries"]:
+                metric_inc("sqlite_queries_total", sql["queries"], route=path)
+                metric_inc("sqlite_query_seconds_total", sql["seconds"], route=path)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+# ── Trace SQL par requête (debug) ─────────────────────────────────────────────
+# TOUTIENOTES_TRACE=1 active le mode: une requête est tracée si elle porte X-Debug-Trace: 1
+# ou si elle est tirée au sort (TOUTIENOTES_TRACE_SAMPLE, 0..1). Chaque requête SQL est notée
+# (texte, durée, lignes lues ou modifiées, jamais les paramètres), avec un profil de pile
+# échantillonné. Avec TOUTIENOTES_TRACE_SLOW_MS, toutes les requêtes HTTP sont tracées
+# (sans profil) et celles au-dessus du seuil sont loguées avec leurs requêtes SQL.
+# Résumé dans l'en-tête X-Debug-Trace, détail dans un tampon circulaire (/api/admin/traces).
+TRACE_ENABLED = os.environ.get("TOUTIENOTES_TRACE") == "1"
+TRACE_SAMPLE_RATE = float(os.environ.get("TOUTIENOTES_TRACE_SAMPLE", "0"))
+TRACE_SLOW_MS = float(os.environ.get("TOUTIENOTES_TRACE_SLOW_MS", "0"))
+TRACE_BUFFER_SIZE = 200
+TRACE_MAX_QUERIES = 500
+TRACE_PROFILE_INTERVAL_SECONDS = 0.005
+TRACE_PROFILE_TOP = 20
+
+_request_trace = ContextVar("request_trace", default=None)
+_trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+_trace_buffer_lock = threading.Lock()
+
+class TracedCursor(sqlite3.Cursor):
+    """Curseur d'une requête tracée: ajoute à l'entrée les lignes lues et le temps de lecture."""
+    entry = None
+
+    def _count(self, started, rows):
+        self.entry["rows"] += rows
+        self.entry["ms"] += (time.perf_counter() - started) * 1000
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._count(started, row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        started = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self._count(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._count(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._count(started, 1)
+        return row
+
+def _traced_execute(conn: sqlite3.Connection, trace: dict, sql: str, args: tuple):
+    trace["_threads"].add(threading.get_ident())
+    entry = {"sql": " ".join(sql.split()), "ms": 0.0, "rows": 0}
+    started = time.perf_counter()
+    cur = conn.cursor(TracedCursor)
+    cur.entry = entry
+    cur.execute(sql, *args)
+    entry["ms"] += (time.perf_counter() - started) * 1000
+    if cur.description is None:
+        entry["rows"] = max(cur.rowcount, 0)
+    if len(trace["queries"]) < TRACE_MAX_QUERIES:
+        trace["queries"].append(entry)
+    else:
+        trace["dropped_queries"] += 1
+    return cur
+
+def _sample_stacks(trace: dict, stop: threading.Event):
+    """Échantillonne les piles des threads qui ont exécuté du SQL pour la requête tracée."""
+    counts = {}
+    while not stop.wait(TRACE_PROFILE_INTERVAL_SECONDS):
+        frames = sys._current_frames()
+        for ident in list(trace["_threads"]):
+            frame = frames.get(ident)
+            # Thread rendu au pool (en attente d'une tâche): l'échantillon n'est plus à nous
+            if frame is None or frame.f_code.co_filename.endswith(("threading.py", "queue.py")):
+                continue
+            stack = []
+            while frame is not None and len(stack) < 40:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+    top = sorted(counts.items(), key=lambda item: -item[1])[:TRACE_PROFILE_TOP]
+    trace["profile"] = [{"stack": stack, "samples": n} for stack, n in top]
+
+def _finish_trace(trace: dict, scope: dict, status: int, started: float):
+    route = scope.get("route")
+    trace.update(
+        route=getattr(route, "path", None),
+        status=status,
+        total_ms=round((time.perf_counter() - started) * 1000, 3),
+        sql_ms=round(sum(q["ms"] for q in trace["queries"]), 3),
+        query_count=len(trace["queries"]) + trace["dropped_queries"],
+    )
+
+class TraceMiddleware:
+    """Middleware ASGI du mode trace: décide si la requête est tracée et publie le résultat."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        requested = (b"x-debug-trace", b"1") in scope["headers"]
+        sampled = not requested and TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+        if not (requested or sampled or TRACE_SLOW_MS > 0):
+            return await self.app(scope, receive, send)
+
+        trace = {
+            "id": uuid.uuid4().hex[:12], "method": scope["method"], "path": scope["path"],
+            "reason": "header" if requested else "sample" if sampled else "slow",
+            "started_at": datetime.utcnow().isoformat(), "queries": [], "dropped_queries": 0,
+            "profile": None, "_threads": set(),
+        }
+        started = time.perf_counter()
+        stop = None
+        if requested or sampled:
+            stop = threading.Event()
+            sampler = threading.Thread(target=_sample_stacks, args=(trace, stop), daemon=True)
+            sampler.start()
+        token = _request_trace.set(trace)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if requested or sampled:
+                    _finish_trace(trace, scope, status, started)
+                    summary = f"id={trace['id']}; queries={trace['query_count']}; sql_ms={trace['sql_ms']}; total_ms={trace['total_ms']}"
+                    message["headers"] = list(message.get("headers", [])) + [(b"x-debug-trace", summary.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_trace.reset(token)
+            if stop is not None:
+                stop.set()
+                sampler.join()
+            _finish_trace(trace, scope, status, started)
+            trace.pop("_threads")
+            slow = TRACE_SLOW_MS > 0 and trace["total_ms"] >= TRACE_SLOW_MS
+            if slow or trace["reason"] != "slow":
+                with _trace_buffer_lock:
+                    _trace_buffer.append(trace)
+            if slow:
+                print(f"[Trace] requête lente {trace['method']} {trace['path']}: {trace['total_ms']} ms, "
+                      f"{trace['query_count']} requêtes SQL ({trace['sql_ms']} ms) id={trace['id']}", flush=True)
+                for q in trace["queries"]:
+                    print(f"[Trace]   {q['ms']:8.2f} ms  {q['rows']:6d} lignes  {q['sql'][:200]}", flush=True)
+
+if TRACE_ENABLED:
+    app.add_middleware(TraceMiddleware)
+
+# ── DB pool ────────────────────────────────────────────────────────────────────
+# Une connexion persistante par thread (threadpool FastAPI, threads de fond), configurée une fois.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",       # ~16 Mo de cache de pages par connexion
+    "PRAGMA mmap_size = 268435456",     # 256 Mo
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA foreign_keys = ON",
+)
+
+_db_local = threading.local()
+_db_pool_lock = threading.Lock()
+db_pool_stats = {"opened": 0, "checkouts": 0, "reused": 0, "overflow": 0, "in_use": 0}
+
+class PooledConnection(sqlite3.Connection):
+    """close() rend la connexion au pool de son thread (transaction non validée annulée, comme avant)."""
+    pooled = False
+
+    def close(self):
+        if not self.pooled:
+            super().close()
+            return
+        if getattr(_db_local, "in_use", False):
+            if self.in_transaction:
+                self.rollback()
+            _db_local.in_use = False
+            with _db_pool_lock:
+                db_pool_stats["in_use"] -= 1
+
+class MeteredConnection(PooledConnection):
+    """
+    Utilisée seulement si METRICS_ENABLED ou TRACE_ENABLED: chronomètre chaque requête
+    (hors itération du curseur) et la note dans la trace de la requête HTTP si elle est tracée.
+    """
+
+    def _metered(self, method, *args):
+        trace = _request_trace.get()
+        if trace is not None and method is sqlite3.Connection.execute:
+            method = lambda conn, sql, *params: _traced_execute(conn, trace, sql, params)
+        if not METRICS_ENABLED:
+            return method(self, *args)
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            sql = _request_sql.get()
+            if sql is not None:
+                sql["queries"] += 1
+                sql["seconds"] += elapsed
+            else:
+                metric_inc("sqlite_queries_total", route="(arrière-plan)")
+                metric_inc("sqlite_query_seconds_total", elapsed, route="(arrière-plan)")
+
+    def execute(self, *args):
+        return self._metered(sqlite3.Connection.execute, *args)
+
+    def executemany(self, *args):
+        return self._metered(sqlite3.Connection.executemany, *args)
+
+def _open_db() -> PooledConnection:
+    conn = sqlite3.connect(DB_PATH, factory=MeteredConnection if METRICS_ENABLED or TRACE_ENABLED else PooledConnection)
     conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON")
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    # Utilisée par la vue notes_fts_src et les triggers FTS: l'index voit toujours le texte clair
+    conn.create_function("note_content", 2, decode_note_content, deterministic=True)
+    with _db_pool_lock:
+        db_pool_stats["opened"] += 1
     return conn
 
-def init_db():
+def get_db():
+    """
+    Connexion du thread courant. Si elle est déjà empruntée (appel imbriqué, endpoint async
+    qui attend), une connexion de débordement est ouverte et vraiment fermée au close().
+    """
+    with _db_pool_lock:
+        db_pool_stats["checkouts"] += 1
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None and not getattr(_db_local, "in_use", False):
+        _db_local.in_use = True
+        with _db_pool_lock:
+            db_pool_stats["reused"] += 1
+            db_pool_stats["in_use"] += 1
+        return conn
+    if conn is not None:
+        with _db_pool_lock:
+            db_pool_stats["overflow"] += 1
+        return _open_db()
+    conn = _open_db()
+    conn.pooled = True
+    _db_local.conn = conn
+    _db_local.in_use = True
+    with _db_pool_lock:
+        db_pool_stats["in_use"] += 1
+    return conn
+
+@contextmanager
+def db_session():
     db = get_db()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# ── DB snapshot (mode base locale) ─────────────────────────────────────────────
+# Copie via l'API backup de SQLite dans un .part puis rename atomique: le client Nextcloud
+# ne voit jamais un fichier à moitié écrit. Déclenché après SNAPSHOT_QUIET_SECONDS sans écriture,
+# au plus tard SNAPSHOT_MAX_INTERVAL_SECONDS après la première écriture non sauvegardée.
+SNAPSHOT_POLL_SECONDS = 5
+SNAPSHOT_QUIET_SECONDS = 30
+SNAPSHOT_MAX_INTERVAL_SECONDS = 300
+
+snapshot_state = {"enabled": bool(LOCAL_DB_PATH), "last_snapshot_at": None, "last_duration_ms": None,
+                  "snapshots": 0, "restored_from_snapshot": False, "error": None}
+_snapshot_lock = threading.Lock()
+
+def _db_files_mtime(path: Path) -> float:
+    """mtime effectif de la base: le fichier principal ou son WAL, le plus récent."""
+    mtimes = [p.stat().st_mtime for p in (path, Path(f"{path}-wal")) if p.exists()]
+    return max(mtimes) if mtimes else 0.0
+
+def _backup_db(src_path: Path, dest_path: Path, journal_mode: str):
+    tmp_path = dest_path.with_name(f".{dest_path.name}.part")
+    if tmp_path.exists():
+        tmp_path.unlink()
+    src = sqlite3.connect(src_path)
+    dst = sqlite3.connect(tmp_path)
+    try:
+        src.backup(dst)
+        dst.execute(f"PRAGMA journal_mode = {journal_mode}")
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp_path, dest_path)
+
+def restore_db_snapshot():
+    """Au démarrage: restaure la base locale depuis le snapshot si elle manque ou est plus ancienne."""
+    if not LOCAL_DB_PATH or not SNAPSHOT_PATH.exists():
+        return
+    if DB_PATH.exists() and _db_files_mtime(DB_PATH) >= SNAPSHOT_PATH.stat().st_mtime:
+        return
+    for stale in (Path(f"{DB_PATH}-wal"), Path(f"{DB_PATH}-shm")):
+        if stale.exists():
+            stale.unlink()
+    _backup_db(SNAPSHOT_PATH, DB_PATH, "WAL")
+    snapshot_state["restored_from_snapshot"] = True
+    print(f"Base locale restaurée depuis {SNAPSHOT_PATH}", flush=True)
+
+def snapshot_db():
+    if not LOCAL_DB_PATH:
+        return False
+    with _snapshot_lock, file_lock(Path(f"{DB_PATH}.snapshot.lock")):
+        started = time.monotonic()
+        source_mtime = _db_files_mtime(DB_PATH)
+        _backup_db(DB_PATH, SNAPSHOT_PATH, "DELETE")
+        # Le snapshot porte le mtime de la base copiée: au redémarrage, égalité = rien à restaurer
+        os.utime(SNAPSHOT_PATH, (source_mtime, source_mtime))
+        snapshot_state.update(
+            last_snapshot_at=datetime.utcnow().isoformat(),
+            last_duration_ms=int((time.monotonic() - started) * 1000),
+            snapshots=snapshot_state["snapshots"] + 1,
+            error=None,
+        )
+    return True
+
+def _snapshot_loop():
+    # Un seul worker pilote les snapshots: celui qui obtient le verrou, gardé à vie
+    leader = open(Path(f"{DB_PATH}.leader.lock"), "a")
+    fcntl.flock(leader, fcntl.LOCK_EX)
+    dirty_since = None
+    while True:
+        time.sleep(SNAPSHOT_POLL_SECONDS)
+        try:
+            mtime = _db_files_mtime(DB_PATH)
+            snapshot_mtime = SNAPSHOT_PATH.stat().st_mtime if SNAPSHOT_PATH.exists() else 0.0
+            if mtime <= snapshot_mtime:
+                dirty_since = None
+                continue
+            now = time.time()
+            dirty_since = dirty_since or now
+            if now - mtime >= SNAPSHOT_QUIET_SECONDS or now - dirty_since >= SNAPSHOT_MAX_INTERVAL_SECONDS:
+                snapshot_db()
+                dirty_since = None
+        except Exception as e:
+            snapshot_state["error"] = str(e)
+            print(f"Erreur snapshot base: {e}", flush=True)
+
+# ── DB init ────────────────────────────────────────────────────────────────────
+
+def normalize_title(title: str) -> str:
+    return (title or "").strip().lower()
+
+_WIKILINK_RE = re.compile(r"\[\[([^\[\]]+)\]\]")
+# Lien entre guillemets (href="...") ou parenthèses (markdown): jusqu'au délimiteur fermant, espaces compris;
+# lien nu dans le texte: jusqu'au premier blanc
+_NOTE_URI_RE = re.compile(
+    r'"toutienote://note/([^"\n]+)"'
+    r"|'toutienote://note/([^'\n]+)'"
+    r"|\(toutienote://note/([^()\n]+)\)"
+    r"|toutienote://note/([^\s\"'<>()\[\]]+)"
+)
+
+def extract_link_keys(content: str):
+    """Titres normalisés ciblés par [[Titre]] et toutienote://note/<titre encodé>."""
+    if not content:
+        return []
+    targets = _WIKILINK_RE.findall(content)
+    # unquote_plus: le client Android encode avec URLEncoder (espace → "+")
+    targets.extend(unquote_plus(next(filter(None, groups))) for groups in _NOTE_URI_RE.findall(content))
+    return sorted({key for key in map(normalize_title, targets) if key})
+
+def sync_note_links(db: sqlite3.Connection, note_id: str, user_id: str, content: str):
+    db.execute("DELETE FROM note_links WHERE source_id=?", (note_id,))
+    db.executemany(
+        "INSERT INTO note_links (source_id, user_id, target_key) VALUES (?,?,?)",
+        [(note_id, user_id, key) for key in extract_link_keys(content)]
+    )
+
+def bump_note_change(db: sqlite3.Connection, note_id: str):
+    """Marque une note comme modifiée pour le sync delta quand seule une table liée change (ex. tags)."""
+    db.execute("UPDATE sync_counter SET value = value + 1 WHERE id = 1")
+    db.execute(
+        "UPDATE notes SET change_seq = (SELECT value FROM sync_counter WHERE id = 1) WHERE id = ?",
+        (note_id,)
+    )
+
+def _add_column(db: sqlite3.Connection, table: str, column: str, col_type: str):
+    if not any(col["name"] == column for col in db.execute(f"PRAGMA table_info({table})")):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {col_type}")
+
+def _migration_initial_schema(db: sqlite3.Connection):
+    """Schéma historique: tables de base, colonnes ajoutées au fil du temps, utilisateur default."""
     db.execute("""
         CREATE TABLE IF NOT EXISTS notes (
             id      TEXT PRIMARY KEY,
@@ -72,11 +678,8 @@ def init_db():
             created_at    TEXT NOT NULL
         )
     """)
-    # Migration: vault_config key "vault_pin" -> "default:vault_pin" pour multi-user
-    try:
-        db.execute("UPDATE vault_config SET key = 'default:vault_pin' WHERE key = 'vault_pin'")
-    except Exception:
-        pass
+    # vault_config key "vault_pin" -> "default:vault_pin" pour multi-user
+    db.execute("UPDATE vault_config SET key = 'default:vault_pin' WHERE key = 'vault_pin'")
     db.execute("""
         CREATE TABLE IF NOT EXISTS albums (
             id         TEXT PRIMARY KEY,
@@ -130,7 +733,7 @@ def init_db():
             created_at      TEXT NOT NULL
         )
     """)
-    migrations = [
+    columns = [
         ("albums", "pin_hash", "TEXT"),
         ("albums", "sort_order", "INTEGER DEFAULT 0"),
         ("albums", "user_id", "TEXT"),
@@ -147,11 +750,8 @@ def init_db():
         ("photos", "sort_order", "INTEGER DEFAULT 0"),
         ("photos", "favorite", "INTEGER DEFAULT 0"),
     ]
-    for table, col, col_type in migrations:
-        try:
-            db.execute(f"ALTER TABLE {table} ADD COLUMN {col} {col_type}")
-        except Exception:
-            pass
+    for table, col, col_type in columns:
+        _add_column(db, table, col, col_type)
 
     db.execute("UPDATE photos SET favorite=0 WHERE favorite IS NULL")
     db.execute("UPDATE notes SET created_at = updated_at WHERE created_at IS NULL OR created_at = ''")
@@ -163,24 +763,241 @@ def init_db():
     db.execute("CREATE INDEX IF NOT EXISTS idx_tags_user_name ON tags(user_id, name)")
     db.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_note ON note_tags(note_id)")
     db.execute("CREATE INDEX IF NOT EXISTS idx_note_attachments_note ON note_attachments(note_id)")
-    db.commit()
-    # Migration: default user pour données existantes (après ajout user_id)
-    try:
-        default_id = "default"
-        default_token = "default"
-        now = datetime.utcnow().isoformat()
-        db.execute(
-            "INSERT OR IGNORE INTO users (id, username, password_hash, token, created_at) VALUES (?,?,?,?,?)",
-            (default_id, "default", hashlib.sha256("default".encode()).hexdigest(), default_token, now)
+    # Utilisateur default pour les données d'avant le multi-user (après ajout user_id)
+    default_id = "default"
+    default_token = "default"
+    now = datetime.utcnow().isoformat()
+    db.execute(
+        "INSERT OR IGNORE INTO users (id, username, password_hash, token, created_at) VALUES (?,?,?,?,?)",
+        (default_id, "default", hashlib.sha256("default".encode()).hexdigest(), default_token, now)
+    )
+    db.execute("UPDATE notes SET user_id = ? WHERE user_id IS NULL OR user_id = ''", (default_id,))
+    db.execute("UPDATE albums SET user_id = ? WHERE user_id IS NULL OR user_id = ''", (default_id,))
+
+def _migration_note_columns(db: sqlite3.Connection):
+    _add_column(db, "notes", "change_seq", "INTEGER")
+    _add_column(db, "notes", "content_codec", "TEXT")
+    _add_column(db, "notes", "title_key", "TEXT")
+    db.executemany(
+        "UPDATE notes SET title_key=? WHERE rowid=?",
+        [(normalize_title(row["title"]), row["rowid"]) for row in db.execute("SELECT rowid, title FROM notes").fetchall()]
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_title_key ON notes(user_id, title_key)")
+    db.execute("""
+        CREATE INDEX IF NOT EXISTS idx_notes_user_order
+        ON notes(user_id, is_pinned DESC, is_favorite DESC, updated_at DESC, id DESC)
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_users_token ON users(token)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_photos_album ON photos(album_id)")
+
+def _migration_notes_fts(db: sqlite3.Connection):
+    """Recherche plein texte: index FTS5 externe sur la vue décompressée, tenu à jour par triggers."""
+    db.execute("""
+        CREATE VIEW IF NOT EXISTS notes_fts_src AS
+        SELECT rowid, title, note_content(content, content_codec) AS content FROM notes
+    """)
+    db.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, content,
+            content='notes_fts_src', content_rowid='rowid',
+            tokenize='unicode61 remove_diacritics 2'
         )
-        db.execute("UPDATE notes SET user_id = ? WHERE user_id IS NULL OR user_id = ''", (default_id,))
-        db.execute("UPDATE albums SET user_id = ? WHERE user_id IS NULL OR user_id = ''", (default_id,))
-        db.commit()
-    except Exception:
-        pass
-    db.close()
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_ai AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts(rowid, title, content)
+            VALUES (new.rowid, new.title, note_content(new.content, new.content_codec));
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_ad AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content)
+            VALUES ('delete', old.rowid, old.title, note_content(old.content, old.content_codec));
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_fts_au AFTER UPDATE OF title, content, content_codec ON notes BEGIN
+            INSERT INTO notes_fts(notes_fts, rowid, title, content)
+            VALUES ('delete', old.rowid, old.title, note_content(old.content, old.content_codec));
+            INSERT INTO notes_fts(rowid, title, content)
+            VALUES (new.rowid, new.title, note_content(new.content, new.content_codec));
+        END
+    """)
+    db.execute("INSERT INTO notes_fts(notes_fts) VALUES ('rebuild')")
+
+def _migration_note_links(db: sqlite3.Connection):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS note_links (
+            source_id  TEXT NOT NULL,
+            user_id    TEXT,
+            target_key TEXT NOT NULL,
+            PRIMARY KEY (source_id, target_key),
+            FOREIGN KEY (source_id) REFERENCES notes(id) ON DELETE CASCADE
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_note_links_target ON note_links(user_id, target_key)")
+    for row in db.execute("SELECT id, user_id, note_content(content, content_codec) AS content FROM notes").fetchall():
+        sync_note_links(db, row["id"], row["user_id"], row["content"])
+
+def _migration_note_sync(db: sqlite3.Connection):
+    """Sync delta: compteur monotone global, chaque écriture sur une note reçoit la valeur suivante."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS note_tombstones (
+            note_id    TEXT PRIMARY KEY,
+            user_id    TEXT,
+            change_seq INTEGER NOT NULL,
+            deleted_at TEXT NOT NULL
+        )
+    """)
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS sync_counter (
+            id    INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )
+    """)
+    db.execute("UPDATE notes SET change_seq = rowid WHERE change_seq IS NULL")
+    db.execute("INSERT OR IGNORE INTO sync_counter (id, value) SELECT 1, COALESCE(MAX(change_seq), 0) FROM notes")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_change ON notes(user_id, change_seq)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_note_tombstones_user_change ON note_tombstones(user_id, change_seq)")
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_sync_ai AFTER INSERT ON notes BEGIN
+            UPDATE sync_counter SET value = value + 1 WHERE id = 1;
+            UPDATE notes SET change_seq = (SELECT value FROM sync_counter WHERE id = 1) WHERE id = new.id;
+            DELETE FROM note_tombstones WHERE note_id = new.id;
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_sync_au AFTER UPDATE ON notes
+        WHEN new.change_seq IS old.change_seq
+         AND (new.content_codec IS old.content_codec OR new.updated_at IS NOT old.updated_at) BEGIN
+            UPDATE sync_counter SET value = value + 1 WHERE id = 1;
+            UPDATE notes SET change_seq = (SELECT value FROM sync_counter WHERE id = 1) WHERE id = new.id;
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS notes_sync_ad AFTER DELETE ON notes BEGIN
+            UPDATE sync_counter SET value = value + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO note_tombstones (note_id, user_id, change_seq, deleted_at)
+            VALUES (old.id, old.user_id, (SELECT value FROM sync_counter WHERE id = 1), strftime('%Y-%m-%dT%H:%M:%f', 'now'));
+        END
+    """)
+
+def _migration_note_revisions(db: sqlite3.Connection):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS note_revisions (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            note_id    TEXT NOT NULL,
+            seq        INTEGER NOT NULL,
+            kind       TEXT NOT NULL,
+            title      TEXT,
+            data       BLOB NOT NULL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            UNIQUE(note_id, seq)
+        )
+    """)
+
+def _migration_jobs(db: sqlite3.Connection):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id           TEXT PRIMARY KEY,
+            kind         TEXT NOT NULL,
+            params       TEXT NOT NULL DEFAULT '{}',
+            status       TEXT NOT NULL DEFAULT 'queued',
+            state        TEXT NOT NULL,
+            worker       TEXT,
+            created_at   TEXT NOT NULL,
+            heartbeat_at REAL
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, heartbeat_at)")
+
+def _migration_photo_index(db: sqlite3.Connection):
+    """Propriétaire des photos + journal des changements qui tient à jour l'index pHash de chaque worker."""
+    _add_column(db, "photos", "user_id", "TEXT")
+    db.execute("UPDATE photos SET user_id = (SELECT user_id FROM albums WHERE albums.id = photos.album_id) WHERE user_id IS NULL")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_photos_user ON photos(user_id)")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS photo_changes (
+            seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+            photo_id TEXT NOT NULL
+        )
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS photos_index_ai AFTER INSERT ON photos BEGIN
+            INSERT INTO photo_changes (photo_id) VALUES (new.id);
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS photos_index_au AFTER UPDATE OF phash, user_id, media_type ON photos BEGIN
+            INSERT INTO photo_changes (photo_id) VALUES (new.id);
+        END
+    """)
+    db.execute("""
+        CREATE TRIGGER IF NOT EXISTS photos_index_ad AFTER DELETE ON photos BEGIN
+            INSERT INTO photo_changes (photo_id) VALUES (old.id);
+        END
+    """)
+
+def _migration_photo_hashes(db: sqlite3.Connection):
+    """Hash crop-resistant et resize calculés une fois par version de fichier (le scan ne recalcule que le neuf)."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            photo_id     TEXT PRIMARY KEY,
+            file_version TEXT NOT NULL,
+            crop_hash    TEXT,
+            resize_hash  TEXT,
+            computed_at  TEXT NOT NULL,
+            FOREIGN KEY (photo_id) REFERENCES photos(id) ON DELETE CASCADE
+        )
+    """)
+
+def _migration_reindex_note_links(db: sqlite3.Connection):
+    """Liens toutienote://note/ avec espaces ou encodés par URLEncoder ("+"): réindexés avec le nouvel extracteur."""
+    for row in db.execute(
+        "SELECT id, user_id, note_content(content, content_codec) AS content FROM notes WHERE content LIKE '%toutienote://note/%' OR content_codec IS NOT NULL"
+    ).fetchall():
+        sync_note_links(db, row["id"], row["user_id"], row["content"])
+
+# Migrations versionnées: PRAGMA user_version = numéro de la dernière étape appliquée.
+# Ne jamais modifier une étape publiée: en ajouter une nouvelle à la fin.
+MIGRATIONS = [
+    (1, "schéma initial", _migration_initial_schema),
+    (2, "colonnes et index des notes", _migration_note_columns),
+    (3, "recherche FTS5", _migration_notes_fts),
+    (4, "index des liens", _migration_note_links),
+    (5, "sync delta", _migration_note_sync),
+    (6, "révisions des notes", _migration_note_revisions),
+    (7, "jobs partagés entre workers", _migration_jobs),
+    (8, "index pHash des photos", _migration_photo_index),
+    (9, "hash persistés des photos", _migration_photo_hashes),
+    (10, "réindexation des liens toutienote://", _migration_reindex_note_links),
+]
 
-init_db()
+def init_db():
+    with db_session() as db:
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        for target, name, step in MIGRATIONS:
+            if target <= version:
+                continue
+            started = time.monotonic()
+            db.execute("BEGIN")
+            try:
+                step(db)
+                db.execute(f"PRAGMA user_version = {target}")
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            print(f"[DB] migration {target} ({name}): {(time.monotonic() - started) * 1000:.1f} ms", flush=True)
+
+_init_started = time.perf_counter()
+with file_lock(Path(f"{DB_PATH}.startup.lock")):
+    restore_db_snapshot()
+    init_db()
+startup_report["init_db_ms"] = round((time.perf_counter() - _init_started) * 1000, 1)
+if LOCAL_DB_PATH:
+    threading.Thread(target=_snapshot_loop, daemon=True).start()
 
 # ── Models ─────────────────────────────────────────────────────────────────────
 class NoteIn(BaseModel):
@@ -218,6 +1035,22 @@ class AuthPasswordChange(BaseModel):
 class NoteTagsUpdate(BaseModel):
     tags: list[str] = []
 
+class NoteBatchOp(BaseModel):
+    op: str                         # create | update | delete | color | pin | favorite
+    id: str | None = None
+    title: str = ""
+    content: str = ""
+    hidden: bool = False
+    color_tag: str | None = None
+    value: bool | None = None       # pin/favorite: état voulu, None = bascule
+
+class NoteBatch(BaseModel):
+    ops: list[NoteBatchOp]
+
+class NoteTitlesLookup(BaseModel):
+    titles: list[str]
+    include_hidden: bool = True
+
 class CropParams(BaseModel):
     x: int
     y: int
@@ -246,24 +1079,27 @@ class PhotoReorder(BaseModel):
 def hash_pin(pin: str) -> str:
     return hashlib.sha256(pin.encode()).hexdigest()
 
+# Pool borné pour le travail bloquant des uploads (copie disque, décodage PIL, pHash, WebP,
+# sqlite): l'event loop ne fait qu'attendre, et quelques gros uploads simultanés ne peuvent
+# pas saturer le threadpool partagé par les routes synchrones.
+MEDIA_WORKERS = int(os.environ.get("TOUTIENOTES_MEDIA_WORKERS", min(4, os.cpu_count() or 1)))
+_media_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+
+async def run_media(fn, *args):
+    # Contexte copié (comme run_in_threadpool): le SQL reste attribué à la route (trace, métriques)
+    ctx = copy_context()
+    return await asyncio.get_running_loop().run_in_executor(_media_executor, ctx.run, fn, *args)
+
 def compute_phash(image_path: Path) -> str:
-    if imagehash is None:
+    if not imagehash:
         return ""
     try:
-        img = Image.open(image_path)
-        return str(imagehash.phash(img))
+        with metric_timer("image_processing_seconds", op="phash"):
+            img = Image.open(image_path)
+            return str(photo_hashing.phash(img))
     except Exception:
         return ""
 
-def compute_crop_hash(image_path: Path):
-    if imagehash is None:
-        return None
-    try:
-        img = Image.open(image_path)
-        return imagehash.crop_resistant_hash(img, hash_func=imagehash.phash)
-    except Exception:
-        return None
-
 def are_crop_similar(ch1, ch2) -> bool:
     """Check if two images are crops of each other. 30% segments, diff≤10 — détecte les vrais crops (ex. 40%)."""
     try:
@@ -298,14 +1134,120 @@ def are_crop_similar(ch1, ch2) -> bool:
     needed = max(1, int(len(small) * 0.80))
     return matched >= needed
 
-def compute_resize_hash(image_path: Path):
-    if imagehash is None:
-        return None
+# ── Hash persistés (photo_hashes) ─────────────────────────────────────────────
+# Clé: photo + version du fichier (nom, taille, mtime). Un remplacement, un crop ou un resize
+# change la version: le scan recalcule. Un échec de décodage est mémorisé (hash NULL).
+def photo_file_version(path: Path):
+    return photo_hashing.file_version(path)
+
+def record_hash_timings(result: dict):
+    for op, seconds in result["timings"].items():
+        metric_observe("image_processing_seconds", seconds, op=op)
+
+def compute_photo_hashes(path: Path):
+    """(crop_hash, resize_hash) en hexadécimal, None pour ceux qui échouent. Un seul décodage."""
+    result = photo_hashing.hash_photo_file(str(path))
+    record_hash_timings(result)
+    return result["crop_hash"], result["resize_hash"]
+
+def save_photo_hashes(db: sqlite3.Connection, photo_id: str, version: str, crop_hex, resize_hex):
+    db.execute(
+        """
+        INSERT INTO photo_hashes (photo_id, file_version, crop_hash, resize_hash, computed_at) VALUES (?,?,?,?,?)
+        ON CONFLICT(photo_id) DO UPDATE SET
+            file_version=excluded.file_version, crop_hash=excluded.crop_hash,
+            resize_hash=excluded.resize_hash, computed_at=excluded.computed_at
+        """,
+        (photo_id, version, crop_hex, resize_hex, datetime.utcnow().isoformat())
+    )
+
+def update_photo_hashes(photo_id: str, filename: str):
+    """Calcule et enregistre les hash de la version courante du fichier si besoin. Retourne (crop, resize)."""
+    path = VAULT_DIR / filename
+    version = photo_file_version(path)
+    if version is None or not imagehash:
+        return None, None
+    with db_session() as db:
+        row = db.execute("SELECT file_version, crop_hash, resize_hash FROM photo_hashes WHERE photo_id=?", (photo_id,)).fetchone()
+    if row is not None and row["file_version"] == version:
+        return row["crop_hash"], row["resize_hash"]
+    crop_hex, resize_hex = compute_photo_hashes(path)
+    with db_session() as db:
+        # La photo a pu être supprimée pendant le calcul: la clé étrangère refuserait l'insertion
+        if db.execute("SELECT 1 FROM photos WHERE id=?", (photo_id,)).fetchone():
+            save_photo_hashes(db, photo_id, version, crop_hex, resize_hex)
+            db.commit()
+    return crop_hex, resize_hex
+
+# Exécuteur séparé du pool média: un upload n'attend jamais le crop hash de l'upload précédent
+_photo_hash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="photo-hash")
+
+def schedule_photo_hashes(photo_id: str, filename: str):
+    """Après upload/remplacement: calcul en arrière-plan, sans faire attendre la réponse."""
+    def run():
+        try:
+            update_photo_hashes(photo_id, filename)
+        except Exception as e:
+            print(f"Erreur hash photo {photo_id}: {e}", flush=True)
+    _photo_hash_executor.submit(run)
+
+# ── Pool de processus du scan de doublons ─────────────────────────────────────
+# Le crop-resistant hash est du calcul pur (GIL): seuls des processus occupent plusieurs cœurs.
+# Contexte spawn: les workers n'importent que photo_hashing, jamais main (ni base, ni app, ni threads).
+SCAN_HASH_WORKERS = max(1, int(os.environ.get("TOUTIENOTES_SCAN_WORKERS", os.cpu_count() or 1)))
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+
+def _get_scan_pool():
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = ProcessPoolExecutor(max_workers=SCAN_HASH_WORKERS,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        return _scan_pool
+
+def _discard_scan_pool():
+    global _scan_pool
+    with _scan_pool_lock:
+        pool, _scan_pool = _scan_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def scan_pool_map(func, items: list, args_of):
+    """
+    Génère (item, func(*args_of(item))) dans l'ordre de fin de calcul, sur le pool du scan
+    si SCAN_HASH_WORKERS > 1. Un worker tué (mémoire, image piégée) casse le pool: les items
+    restants sont calculés ici.
+    """
+    if SCAN_HASH_WORKERS <= 1 or len(items) < 2:
+        for item in items:
+            yield item, func(*args_of(item))
+        return
+    def submit_all():
+        pool = _get_scan_pool()
+        return {pool.submit(func, *args_of(item)): item for item in items}
     try:
-        img = Image.open(image_path).resize((128, 128)).convert("L")
-        return imagehash.phash(img, hash_size=16)
-    except Exception:
-        return None
+        futures = submit_all()
+    except BrokenProcessPool:
+        _discard_scan_pool()  # cassé lors d'un scan précédent: on repart d'un pool neuf
+        futures = submit_all()
+    lost = []
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            lost.append(futures[future])
+            continue
+        yield futures[future], result
+    if lost:
+        print(f"Pool du scan interrompu, {len(lost)} tâche(s) recalculée(s) sans workers", flush=True)
+        _discard_scan_pool()
+        for item in lost:
+            yield item, func(*args_of(item))
+
+def iter_photo_hashes(photos: list[dict]):
+    """(photo, résultat de photo_hashing.hash_photo_file) dans l'ordre de fin de calcul."""
+    return scan_pool_map(photo_hashing.hash_photo_file, photos, lambda p: (str(VAULT_DIR / p["filename"]),))
 
 # ── CLIP model (lazy-load, ~350MB first download) ─────────────────────────────
 _clip_model = None
@@ -335,42 +1277,140 @@ def compute_clip_embedding(image_path: Path):
         return None
 
 def clip_cosine_sim(a, b) -> float:
-    if np is None:
+    if not np:
         return 0.0
     return float(np.dot(a, b))
 
-# ── Other helpers ──────────────────────────────────────────────────────────────
-def is_duplicate(new_phash: str, threshold: int = 5):
-    if not new_phash or imagehash is None:
+# ── Index pHash (doublons à l'upload) ─────────────────────────────────────────
+# Multi-index hashing: le pHash 64 bits est découpé en PHASH_INDEX_SEGMENTS segments. Deux hash
+# à distance ≤ PHASH_INDEX_SEGMENTS - 1 ont forcément un segment identique (principe des tiroirs):
+# une recherche ne compare que les photos qui partagent un segment, pas toute la table.
+# Tenu à jour depuis photo_changes (triggers): upload, remplacement, suppression, déplacement,
+# y compris quand l'écriture vient d'un autre worker.
+PHASH_INDEX_SEGMENTS = 6
+PHASH_CHANGES_KEEP = 10000
+
+def parse_phash(value) -> int | None:
+    if not value or len(value) != 16:
         return None
-    db = get_db()
-    rows = db.execute("SELECT id, phash FROM photos WHERE phash IS NOT NULL AND media_type='image'").fetchall()
-    db.close()
-    for row in rows:
-        existing_hash = row["phash"]
-        if existing_hash:
-            try:
-                diff = imagehash.hex_to_hash(new_phash) - imagehash.hex_to_hash(existing_hash)
-                if diff <= threshold:
-                    return dict(row)
-            except Exception:
-                pass
-    return None
+    try:
+        return int(value, 16)
+    except ValueError:
+        return None
+
+class PhashIndex:
+    def __init__(self, segments: int = PHASH_INDEX_SEGMENTS):
+        self.segments = []  # (décalage, masque) de chaque segment
+        shift = 0
+        for i in range(segments):
+            bits = 64 // segments + (1 if i < 64 % segments else 0)
+            self.segments.append((shift, (1 << bits) - 1))
+            shift += bits
+        self.tables = [{} for _ in self.segments]  # (propriétaire, valeur du segment) -> {photo_id}
+        self.entries = {}                           # photo_id -> (pHash, propriétaire)
+        self.last_seq = None
+        self.lock = threading.Lock()
+
+    def add(self, photo_id: str, value: int, owner):
+        self.remove(photo_id)
+        self.entries[photo_id] = (value, owner)
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            table.setdefault((owner, (value >> shift) & mask), set()).add(photo_id)
+
+    def remove(self, photo_id: str):
+        entry = self.entries.pop(photo_id, None)
+        if entry is None:
+            return
+        value, owner = entry
+        for table, (shift, mask) in zip(self.tables, self.segments):
+            key = (owner, (value >> shift) & mask)
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(photo_id)
+                if not bucket:
+                    del table[key]
+
+    def search(self, value: int, owners, max_distance: int):
+        """[(distance, photo_id)] des photos de owners à distance ≤ max_distance, les plus proches d'abord."""
+        if max_distance >= len(self.segments):
+            candidates = [pid for pid, (_, owner) in self.entries.items() if owner in owners]
+        else:
+            candidates = set()
+            for table, (shift, mask) in zip(self.tables, self.segments):
+                for owner in owners:
+                    candidates.update(table.get((owner, (value >> shift) & mask), ()))
+        matches = []
+        for photo_id in candidates:
+            distance = (value ^ self.entries[photo_id][0]).bit_count()
+            if distance <= max_distance:
+                matches.append((distance, photo_id))
+        return sorted(matches)
+
+    def sync(self, db: sqlite3.Connection):
+        """Rattrape photo_changes; reconstruit tout au premier appel ou si le journal a été élagué."""
+        bounds = db.execute("SELECT MIN(seq), MAX(seq) FROM photo_changes").fetchone()
+        oldest, newest = bounds[0], bounds[1] or 0
+        if self.last_seq is None or (oldest is not None and oldest > self.last_seq + 1):
+            self.tables = [{} for _ in self.segments]
+            self.entries = {}
+            rows = db.execute("SELECT id, user_id, phash FROM photos WHERE media_type='image' AND phash IS NOT NULL")
+            for row in rows:
+                value = parse_phash(row["phash"])
+                if value is not None:
+                    self.add(row["id"], value, row["user_id"])
+            self.last_seq = newest
+            return
+        if newest <= self.last_seq:
+            return
+        changed = [row[0] for row in db.execute(
+            "SELECT DISTINCT photo_id FROM photo_changes WHERE seq > ? AND seq <= ?", (self.last_seq, newest)
+        ).fetchall()]
+        rows = {
+            row["id"]: row for row in db.execute(
+                "SELECT id, user_id, phash, media_type FROM photos WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(changed),)
+            ).fetchall()
+        }
+        for photo_id in changed:
+            row = rows.get(photo_id)
+            value = parse_phash(row["phash"]) if row is not None and row["media_type"] == "image" else None
+            if value is None:
+                self.remove(photo_id)
+            else:
+                self.add(photo_id, value, row["user_id"])
+        self.last_seq = newest
+
+_phash_index = PhashIndex()
+
+def is_duplicate(new_phash: str, user_id: str, threshold: int = 5):
+    """Photo de user_id (ou sans propriétaire) dont le pHash est à distance ≤ threshold, la plus proche."""
+    value = parse_phash(new_phash)
+    if value is None:
+        return None
+    with _phash_index.lock:
+        db = get_db()
+        try:
+            _phash_index.sync(db)
+        finally:
+            db.close()
+        matches = _phash_index.search(value, (user_id, None), threshold)
+    if not matches:
+        return None
+    distance, photo_id = matches[0]
+    return {"id": photo_id, "distance": distance}
 
 def _config_key(user_id: str, key: str) -> str:
     return f"{user_id}:{key}"
 
 def get_config(user_id: str, key: str):
-    db = get_db()
-    row = db.execute("SELECT value FROM vault_config WHERE key=?", (_config_key(user_id, key),)).fetchone()
-    db.close()
+    with db_session() as db:
+        row = db.execute("SELECT value FROM vault_config WHERE key=?", (_config_key(user_id, key),)).fetchone()
     return row["value"] if row else None
 
 def set_config(user_id: str, key: str, value: str):
-    db = get_db()
-    db.execute("INSERT OR REPLACE INTO vault_config(key,value) VALUES(?,?)", (_config_key(user_id, key), value))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        db.execute("INSERT OR REPLACE INTO vault_config(key,value) VALUES(?,?)", (_config_key(user_id, key), value))
+        db.commit()
 
 def hash_password(pw: str) -> str:
     return hashlib.sha256(pw.encode()).hexdigest()
@@ -388,6 +1428,27 @@ def extract_tags_from_text(*parts: str):
     normalized = [normalize_tag(tag) for tag in found]
     return sorted({tag for tag in normalized if tag})
 
+def build_fts_query(raw: str) -> str:
+    """Convertit la saisie utilisateur en requête FTS5: "phrase exacte" ou mots en préfixe (mot*)."""
+    parts = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', raw or ""):
+        if phrase.strip():
+            parts.append(f'"{phrase.strip()}"')
+        else:
+            term = word.replace('"', "").rstrip("*")
+            if term:
+                parts.append(f'"{term}"*')
+    return " ".join(parts)
+
+# highlight()/snippet() renvoient le texte brut de la note: marqueurs privés dans SQL, puis échappement HTML
+# et seulement ensuite les balises <mark> (une note contenant du HTML reste du texte côté client)
+FTS_MARK_START, FTS_MARK_END = "\ue000", "\ue001"
+
+def render_fts_markup(text):
+    if text is None:
+        return None
+    return html.escape(text).replace(FTS_MARK_START, "<mark>").replace(FTS_MARK_END, "</mark>")
+
 def get_note_tags(db: sqlite3.Connection, note_id: str):
     rows = db.execute(
         """
@@ -401,46 +1462,253 @@ def get_note_tags(db: sqlite3.Connection, note_id: str):
     ).fetchall()
     return [row["name"] for row in rows]
 
-def set_note_tags(db: sqlite3.Connection, note_id: str, user_id: str, tags: list[str]):
-    normalized_tags = []
-    for tag in tags:
-        normalized = normalize_tag(tag)
-        if normalized and normalized not in normalized_tags:
-            normalized_tags.append(normalized)
+def get_tags_for_notes(db: sqlite3.Connection, note_ids: list[str]):
+    """Tags de plusieurs notes en une seule requête (ids passés en JSON, pas de limite de variables)."""
+    tags_by_note = {nid: [] for nid in note_ids}
+    if not note_ids:
+        return tags_by_note
+    rows = db.execute(
+        """
+        SELECT nt.note_id, t.name
+        FROM note_tags nt
+        INNER JOIN tags t ON t.id = nt.tag_id
+        WHERE nt.note_id IN (SELECT value FROM json_each(?))
+        ORDER BY t.name COLLATE NOCASE ASC
+        """,
+        (json.dumps(note_ids),)
+    ).fetchall()
+    for row in rows:
+        tags_by_note[row["note_id"]].append(row["name"])
+    return tags_by_note
+
+def set_note_tags(db: sqlite3.Connection, note_id: str, user_id: str, tags: list[str]) -> bool:
+    """Applique uniquement la différence avec les tags actuels. Retourne False si rien n'a changé."""
+    wanted = {normalize_tag(tag) for tag in tags} - {""}
+    current = {
+        row["name"]: row["id"]
+        for row in db.execute(
+            "SELECT t.id, t.name FROM tags t INNER JOIN note_tags nt ON nt.tag_id = t.id WHERE nt.note_id = ?",
+            (note_id,)
+        ).fetchall()
+    }
+    to_add = sorted(wanted - current.keys())
+    to_remove = [tag_id for name, tag_id in current.items() if name not in wanted]
+    if not to_add and not to_remove:
+        return False
+
+    if to_remove:
+        db.executemany(
+            "DELETE FROM note_tags WHERE note_id=? AND tag_id=?",
+            [(note_id, tag_id) for tag_id in to_remove]
+        )
+    if to_add:
+        now = datetime.utcnow().isoformat()
+        db.executemany(
+            "INSERT OR IGNORE INTO tags (id, user_id, name, created_at) VALUES (?,?,?,?)",
+            [(str(uuid.uuid4()), user_id, name, now) for name in to_add]
+        )
+        db.execute(
+            """
+            INSERT OR IGNORE INTO note_tags (note_id, tag_id)
+            SELECT ?, id FROM tags
+            WHERE user_id=? AND name IN (SELECT value FROM json_each(?))
+            """,
+            (note_id, user_id, json.dumps(to_add))
+        )
+    return True
+
+def sync_note_tags(db: sqlite3.Connection, note_id: str, user_id: str, title: str, content: str) -> bool:
+    return set_note_tags(db, note_id, user_id, extract_tags_from_text(title, content))
+
+# ── Révisions: snapshot complet toutes les N révisions, deltas ligne à ligne entre les deux ──
+REVISION_SNAPSHOT_EVERY = 20
+REVISION_COALESCE_SECONDS = 300
+REVISION_MAX_PER_NOTE = 200
+REVISION_MAX_AGE_DAYS = 90
+REVISION_PRUNE_INTERVAL_SECONDS = 6 * 3600
+
+def _pack_delta(base: str, text: str) -> bytes:
+    """Opcodes compacts: [i1, i2] = lignes copiées depuis la base, "texte" = lignes insérées."""
+    base_lines = base.splitlines(keepends=True)
+    text_lines = text.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, text_lines).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(text_lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode("utf-8"))
+
+def _apply_delta(base: str, data: bytes) -> str:
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(zlib.decompress(data)):
+        parts.append("".join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op)
+    return "".join(parts)
+
+def get_note_revision(db: sqlite3.Connection, note_id: str, seq: int):
+    """Reconstruit une révision: dernier snapshot ≤ seq puis au plus REVISION_SNAPSHOT_EVERY deltas."""
+    rows = db.execute(
+        """
+        SELECT * FROM note_revisions
+        WHERE note_id=? AND seq <= ? AND seq >= (
+            SELECT MAX(seq) FROM note_revisions WHERE note_id=? AND seq <= ? AND kind='snapshot'
+        )
+        ORDER BY seq ASC
+        """,
+        (note_id, seq, note_id, seq)
+    ).fetchall()
+    if not rows or rows[-1]["seq"] != seq:
+        return None
+    content = ""
+    for row in rows:
+        if row["kind"] == "snapshot":
+            content = zlib.decompress(row["data"]).decode("utf-8")
+        else:
+            content = _apply_delta(content, row["data"])
+    revision = {k: rows[-1][k] for k in ("seq", "kind", "title", "created_at", "updated_at")}
+    revision["content"] = content
+    return revision
 
-    db.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
-    now = datetime.utcnow().isoformat()
-    for tag_name in normalized_tags:
-        row = db.execute(
-            "SELECT id FROM tags WHERE user_id=? AND name=?",
-            (user_id, tag_name)
-        ).fetchone()
-        tag_id = row["id"] if row else str(uuid.uuid4())
-        if not row:
-            db.execute(
-                "INSERT INTO tags (id, user_id, name, created_at) VALUES (?,?,?,?)",
-                (tag_id, user_id, tag_name, now)
-            )
+def record_note_revision(db: sqlite3.Connection, note_id: str, title: str, content: str, now: str):
+    """
+    Enregistre l'état après une sauvegarde. Les sauvegardes dans les REVISION_COALESCE_SECONDS
+    suivant l'ouverture de la dernière révision la réécrivent au lieu d'en créer une nouvelle.
+    """
+    content = content or ""
+    latest = db.execute(
+        "SELECT id, seq, kind, created_at FROM note_revisions WHERE note_id=? ORDER BY seq DESC LIMIT 1",
+        (note_id,)
+    ).fetchone()
+    age = datetime.fromisoformat(now) - datetime.fromisoformat(latest["created_at"]) if latest else None
+    if age is not None and timedelta(0) <= age < timedelta(seconds=REVISION_COALESCE_SECONDS):
+        if latest["kind"] == "snapshot":
+            data = zlib.compress(content.encode("utf-8"))
+        else:
+            data = _pack_delta(get_note_revision(db, note_id, latest["seq"] - 1)["content"], content)
         db.execute(
-            "INSERT OR IGNORE INTO note_tags (note_id, tag_id) VALUES (?,?)",
-            (note_id, tag_id)
+            "UPDATE note_revisions SET title=?, data=?, updated_at=? WHERE id=?",
+            (title, data, now, latest["id"])
         )
+        return
+
+    kind = "snapshot"
+    data = None
+    if latest:
+        previous = get_note_revision(db, note_id, latest["seq"])
+        if previous["content"] == content and previous["title"] == title:
+            return
+        last_snapshot = db.execute(
+            "SELECT MAX(seq) FROM note_revisions WHERE note_id=? AND kind='snapshot'",
+            (note_id,)
+        ).fetchone()[0]
+        if latest["seq"] + 1 - last_snapshot < REVISION_SNAPSHOT_EVERY:
+            kind = "delta"
+            data = _pack_delta(previous["content"], content)
+    if data is None:
+        data = zlib.compress(content.encode("utf-8"))
+    seq = latest["seq"] + 1 if latest else 1
+    db.execute(
+        """
+        INSERT INTO note_revisions (note_id, seq, kind, title, data, created_at, updated_at)
+        VALUES (?,?,?,?,?,?,?)
+        """,
+        (note_id, seq, kind, title, data, now, now)
+    )
+    # Aussi après un delta: la limite REVISION_MAX_PER_NOTE peut être dépassée sans nouveau snapshot
+    _prune_note_revisions(db, note_id, now)
+
+def _prune_note_revisions(db: sqlite3.Connection, note_id: str, now: str):
+    """Rétention par groupes entiers (snapshot + deltas) pour que tout ce qui reste soit reconstructible."""
+    rows = db.execute(
+        "SELECT seq, kind, updated_at FROM note_revisions WHERE note_id=? ORDER BY seq ASC",
+        (note_id,)
+    ).fetchall()
+    age_cutoff = (datetime.fromisoformat(now) - timedelta(days=REVISION_MAX_AGE_DAYS)).isoformat()
+    keep_index = 0
+    for index, row in enumerate(rows):
+        if index and row["kind"] == "snapshot" and (
+            len(rows) - keep_index > REVISION_MAX_PER_NOTE or rows[index - 1]["updated_at"] < age_cutoff
+        ):
+            keep_index = index
+    if keep_index:
+        db.execute("DELETE FROM note_revisions WHERE note_id=? AND seq < ?", (note_id, rows[keep_index]["seq"]))
+
+def prune_all_note_revisions() -> int:
+    """Rétention appliquée aux notes qui ne sont plus modifiées (sinon seul l'enregistrement élague)."""
+    now = datetime.utcnow().isoformat()
+    with db_session() as db:
+        # Une seule série snapshot + deltas: rien d'élaguable, la dernière reste toujours
+        note_ids = [row["note_id"] for row in db.execute(
+            "SELECT note_id FROM note_revisions WHERE kind='snapshot' GROUP BY note_id HAVING COUNT(*) > 1"
+        ).fetchall()]
+        for note_id in note_ids:
+            _prune_note_revisions(db, note_id, now)
+            db.commit()
+    return len(note_ids)
+
+def _revision_prune_loop():
+    while True:
+        time.sleep(REVISION_PRUNE_INTERVAL_SECONDS)
+        try:
+            prune_all_note_revisions()
+        except Exception as e:
+            print(f"Erreur rétention des révisions: {e}", flush=True)
 
-def sync_note_tags(db: sqlite3.Connection, note_id: str, user_id: str, title: str, content: str):
-    set_note_tags(db, note_id, user_id, extract_tags_from_text(title, content))
+@app.on_event("startup")
+def start_revision_pruning():
+    threading.Thread(target=_revision_prune_loop, daemon=True).start()
 
 def serialize_note_attachment(row: sqlite3.Row):
     attachment = dict(row)
     attachment["url"] = f"/api/notes/attachments/{attachment['stored_filename']}"
     return attachment
 
+# Cache token -> utilisateur (LRU borné + TTL): la requête la plus fréquente devient un lookup dict
+# Avec plusieurs workers, invalidate_user_tokens n'atteint que le worker courant: TTL court
+AUTH_CACHE_TTL_SECONDS = 300 if WORKERS == 1 else 10
+AUTH_CACHE_MAX_ENTRIES = 1024
+
+_auth_cache = OrderedDict()
+_auth_cache_lock = threading.Lock()
+auth_cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+def _cached_user(token: str):
+    now = time.monotonic()
+    with _auth_cache_lock:
+        entry = _auth_cache.get(token)
+        if entry and entry[0] > now:
+            _auth_cache.move_to_end(token)
+            auth_cache_stats["hits"] += 1
+            return dict(entry[1])
+        auth_cache_stats["misses"] += 1
+    return None
+
+def _load_user_by_token(token: str):
+    with db_session() as db:
+        row = db.execute("SELECT * FROM users WHERE token=?", (token,)).fetchone()
+    if not row:
+        return None
+    user = dict(row)
+    with _auth_cache_lock:
+        _auth_cache[token] = (time.monotonic() + AUTH_CACHE_TTL_SECONDS, user)
+        _auth_cache.move_to_end(token)
+        while len(_auth_cache) > AUTH_CACHE_MAX_ENTRIES:
+            _auth_cache.popitem(last=False)
+            auth_cache_stats["evictions"] += 1
+    return dict(user)
+
 def get_user_by_token(token: str):
     if not token:
         return None
-    db = get_db()
-    row = db.execute("SELECT * FROM users WHERE token=?", (token,)).fetchone()
-    db.close()
-    return dict(row) if row else None
+    return _cached_user(token) or _load_user_by_token(token)
+
+def invalidate_user_tokens(user_id: str):
+    """À appeler après toute modification du compte (mot de passe, token, profil)."""
+    with _auth_cache_lock:
+        for token in [t for t, (_, u) in _auth_cache.items() if u["id"] == user_id]:
+            del _auth_cache[token]
+            auth_cache_stats["invalidations"] += 1
 
 async def get_current_user(authorization: str = Header(None)):
     token = None
@@ -448,11 +1716,20 @@ async def get_current_user(authorization: str = Header(None)):
         token = authorization[7:].strip()
     if not token:
         raise HTTPException(401, "Token requis")
-    user = get_user_by_token(token)
+    # Cache chaud: lookup dict sur l'event loop; cache froid: sqlite hors de l'event loop
+    user = _cached_user(token) or await run_in_threadpool(_load_user_by_token, token)
     if not user:
         raise HTTPException(401, "Token invalide")
     return user
 
+# Routes /api/admin/*: réservées aux comptes listés (TOUTIENOTES_ADMIN_USERS=alice,bob), aucun par défaut
+ADMIN_USERS = {u.strip().lower() for u in os.environ.get("TOUTIENOTES_ADMIN_USERS", "").split(",") if u.strip()}
+
+async def require_admin(user: dict = Depends(get_current_user)):
+    if user["username"] not in ADMIN_USERS:
+        raise HTTPException(403, "Réservé aux administrateurs")
+    return user
+
 # ══════════════════════════════════════════════════════════════════════════════
 # AUTH
 # ══════════════════════════════════════════════════════════════════════════════
@@ -463,38 +1740,35 @@ def register(data: AuthRegister):
         raise HTTPException(400, "Nom d'utilisateur trop court")
     if len(data.password) < 4:
         raise HTTPException(400, "Mot de passe trop court (min 4 caractères)")
-    db = get_db()
-    existing = db.execute("SELECT id FROM users WHERE username=?", (data.username.lower(),)).fetchone()
-    if existing:
-        db.close()
-        raise HTTPException(400, "Ce nom d'utilisateur existe déjà")
-    uid = str(uuid.uuid4())
-    token = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
-    db.execute(
-        "INSERT INTO users (id, username, password_hash, token, created_at) VALUES (?,?,?,?,?)",
-        (uid, data.username.lower(), hash_password(data.password), token, now)
-    )
-    db.commit()
-    db.close()
+    with db_session() as db:
+        existing = db.execute("SELECT id FROM users WHERE username=?", (data.username.lower(),)).fetchone()
+        if existing:
+            raise HTTPException(400, "Ce nom d'utilisateur existe déjà")
+        uid = str(uuid.uuid4())
+        token = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        db.execute(
+            "INSERT INTO users (id, username, password_hash, token, created_at) VALUES (?,?,?,?,?)",
+            (uid, data.username.lower(), hash_password(data.password), token, now)
+        )
+        db.commit()
     return {"token": token, "user_id": uid, "username": data.username, "created_at": now}
 
 @app.post("/api/auth/login")
 def login(data: AuthLogin):
-    db = get_db()
-    row = db.execute(
-        "SELECT id, username, token, created_at FROM users WHERE username=? AND password_hash=?",
-        (data.username.lower(), hash_password(data.password))
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(401, "Identifiants incorrects")
-    # Garder le token existant pour permettre connexion multi-appareils
-    token = row["token"] if row["token"] else str(uuid.uuid4())
-    if not row["token"]:
-        db.execute("UPDATE users SET token=? WHERE id=?", (token, row["id"]))
-        db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT id, username, token, created_at FROM users WHERE username=? AND password_hash=?",
+            (data.username.lower(), hash_password(data.password))
+        ).fetchone()
+        if not row:
+            raise HTTPException(401, "Identifiants incorrects")
+        # Garder le token existant pour permettre connexion multi-appareils
+        token = row["token"] if row["token"] else str(uuid.uuid4())
+        if not row["token"]:
+            db.execute("UPDATE users SET token=? WHERE id=?", (token, row["id"]))
+            db.commit()
+            invalidate_user_tokens(row["id"])
     return {"token": token, "user_id": row["id"], "username": row["username"], "created_at": row["created_at"]}
 
 @app.get("/api/auth/me")
@@ -509,23 +1783,21 @@ def auth_me(user: dict = Depends(get_current_user)):
 def change_password(data: AuthPasswordChange, user: dict = Depends(get_current_user)):
     if len(data.new_password) < 4:
         raise HTTPException(400, "Mot de passe trop court (min 4 caracteres)")
-    db = get_db()
-    row = db.execute(
-        "SELECT password_hash FROM users WHERE id=?",
-        (user["id"],)
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Utilisateur introuvable")
-    if row["password_hash"] != hash_password(data.old_password):
-        db.close()
-        raise HTTPException(401, "Ancien mot de passe incorrect")
-    db.execute(
-        "UPDATE users SET password_hash=? WHERE id=?",
-        (hash_password(data.new_password), user["id"])
-    )
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT password_hash FROM users WHERE id=?",
+            (user["id"],)
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Utilisateur introuvable")
+        if row["password_hash"] != hash_password(data.old_password):
+            raise HTTPException(401, "Ancien mot de passe incorrect")
+        db.execute(
+            "UPDATE users SET password_hash=? WHERE id=?",
+            (hash_password(data.new_password), user["id"])
+        )
+        db.commit()
+    invalidate_user_tokens(user["id"])
     return {"ok": True}
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -534,6 +1806,7 @@ def change_password(data: AuthPasswordChange, user: dict = Depends(get_current_u
 
 def _serialize_note(row: sqlite3.Row, db: sqlite3.Connection | None = None):
     note = dict(row)
+    note["content"] = decode_note_content(note.get("content"), note.pop("content_codec", None))
     note["created_at"] = note.get("created_at") or note.get("updated_at")
     note["is_hidden"] = int(note.get("is_hidden") or 0)
     note["is_pinned"] = int(note.get("is_pinned") or 0)
@@ -543,46 +1816,248 @@ def _serialize_note(row: sqlite3.Row, db: sqlite3.Connection | None = None):
     note.pop("pin_hash", None)
     return note
 
+def _serialize_notes(rows: list[sqlite3.Row], db: sqlite3.Connection):
+    notes = [_serialize_note(r) for r in rows]
+    tags_by_note = get_tags_for_notes(db, [n["id"] for n in notes])
+    for note in notes:
+        note["tags"] = tags_by_note.get(note["id"], [])
+    return notes
+
 def _require_note_pin(pin: str):
     if len(pin) != 4 or not pin.isdigit():
         raise HTTPException(400, "PIN doit etre 4 chiffres")
 
-@app.get("/api/notes")
-def list_notes(include_hidden: bool = False, user: dict = Depends(get_current_user)):
-    db = get_db()
-    hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
-    rows = db.execute(
-        f"""
-        SELECT * FROM notes
-        WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
-        ORDER BY COALESCE(is_pinned,0) DESC, COALESCE(is_favorite,0) DESC, updated_at DESC
+# ── Autosave: tampon d'écriture coalescé pour PUT /api/notes/{id} ────────────
+# L'éditeur sauvegarde à chaque pause de frappe: on garde la dernière version en mémoire
+# et on l'écrit après AUTOSAVE_QUIET_SECONDS sans nouvelle sauvegarde (ou AUTOSAVE_MAX_DELAY_SECONDS max).
+AUTOSAVE_QUIET_SECONDS = 3.0
+AUTOSAVE_MAX_DELAY_SECONDS = 15.0
+# Le tampon est propre au processus: avec plusieurs workers, un GET servi ailleurs le raterait
+AUTOSAVE_BUFFERING = WORKERS == 1
+
+AUTOSAVE_MAX_ATTEMPTS = 3
+
+_pending_notes = {}
+_flushing_notes = {}  # retirées de _pending_notes, en cours d'écriture: encore visibles par get_pending_note
+_pending_lock = threading.RLock()
+_flush_lock = threading.Lock()  # une écriture à la fois: une version plus récente n'est jamais écrasée
+_pending_flusher = None
+
+def _write_note_content(db: sqlite3.Connection, note_id: str, user_id: str, title: str, content: str, now: str) -> bool:
+    stored, codec = encode_note_content(content)
+    cur = db.execute(
+        """
+        UPDATE notes SET title=?, title_key=?, content=?, content_codec=?, updated_at=MAX(COALESCE(updated_at, ''), ?)
+        WHERE id=? AND (user_id=? OR user_id IS NULL)
         """,
-        (user["id"],)
-    ).fetchall()
-    payload = [_serialize_note(r, db) for r in rows]
-    db.close()
+        (title, normalize_title(title), stored, codec, now, note_id, user_id)
+    )
+    if cur.rowcount == 0:
+        return False
+    sync_note_tags(db, note_id, user_id, title, content)
+    sync_note_links(db, note_id, user_id, content)
+    record_note_revision(db, note_id, title, content, now)
+    return True
+
+def buffer_note_write(note_id: str, user_id: str, title: str, content: str, now: str):
+    global _pending_flusher
+    if not AUTOSAVE_BUFFERING:
+        with db_session() as db:
+            _write_note_content(db, note_id, user_id, title, content, now)
+            db.commit()
+        return
+    mono = time.monotonic()
+    with _pending_lock:
+        pending = _pending_notes.get(note_id)
+        _pending_notes[note_id] = {
+            "user_id": user_id, "title": title, "content": content, "updated_at": now,
+            "first_at": pending["first_at"] if pending else mono, "last_at": mono, "attempts": 0,
+        }
+        if _pending_flusher is None:
+            _pending_flusher = threading.Thread(target=_pending_flush_loop, daemon=True)
+            _pending_flusher.start()
+
+def get_pending_note(note_id: str):
+    with _pending_lock:
+        return _pending_notes.get(note_id) or _flushing_notes.get(note_id)
+
+def discard_pending_notes(note_ids: list[str]):
+    with _pending_lock:
+        for note_id in note_ids:
+            _pending_notes.pop(note_id, None)
+
+def _is_due(pending: dict, user_id: str | None, everything: bool, mono: float) -> bool:
+    return (
+        everything
+        or pending["user_id"] == user_id
+        or mono - pending["last_at"] >= AUTOSAVE_QUIET_SECONDS
+        or mono - pending["first_at"] >= AUTOSAVE_MAX_DELAY_SECONDS
+    )
+
+def _take_due_notes(user_id: str | None, everything: bool):
+    """Sous _pending_lock: déplace les sauvegardes échues vers _flushing_notes."""
+    mono = time.monotonic()
+    due = [(note_id, pending) for note_id, pending in _pending_notes.items() if _is_due(pending, user_id, everything, mono)]
+    for note_id, pending in due:
+        del _pending_notes[note_id]
+        _flushing_notes[note_id] = pending
+    return due
+
+def flush_pending_notes(user_id: str | None = None, everything: bool = False):
+    """
+    Écrit les sauvegardes arrivées à échéance, plus toutes celles de user_id si fourni
+    (avant une lecture qui filtre ou trie sur le contenu). Les écritures se font hors de
+    _pending_lock: l'autosave et les lectures des autres utilisateurs n'attendent pas.
+    Une note en cours d'écriture reste visible via get_pending_note jusqu'au commit.
+    """
+    with _pending_lock:
+        mono = time.monotonic()
+        in_flight = any(everything or p["user_id"] == user_id for p in _flushing_notes.values())
+        if not in_flight and not any(_is_due(p, user_id, everything, mono) for p in _pending_notes.values()):
+            return 0
+    # Attendre _flush_lock attend aussi l'écriture en cours des notes de user_id
+    with _flush_lock:
+        with _pending_lock:
+            due = _take_due_notes(user_id, everything)
+        if not due:
+            return 0
+        written = 0
+        db = get_db()
+        try:
+            for note_id, pending in due:
+                try:
+                    _write_note_content(
+                        db, note_id, pending["user_id"], pending["title"], pending["content"], pending["updated_at"]
+                    )
+                    db.commit()
+                    written += 1
+                except Exception as e:
+                    db.rollback()
+                    _requeue_failed_note(note_id, pending, e)
+                finally:
+                    with _pending_lock:
+                        _flushing_notes.pop(note_id, None)
+        finally:
+            db.close()
+        return written
+
+def _requeue_failed_note(note_id: str, pending: dict, error: Exception):
+    """Une note en échec est retentée seule aux ticks suivants, puis abandonnée: elle ne bloque pas les autres."""
+    pending["attempts"] += 1
+    with _pending_lock:
+        if note_id in _pending_notes:
+            print(f"Erreur autosave note {note_id}: {error} (version plus récente en attente)", flush=True)
+        elif pending["attempts"] < AUTOSAVE_MAX_ATTEMPTS:
+            print(f"Erreur autosave note {note_id}: {error} (nouvel essai)", flush=True)
+            _pending_notes[note_id] = pending
+        else:
+            print(f"Erreur autosave note {note_id}: {error} (abandonnée après {pending['attempts']} essais)", flush=True)
+
+def _pending_flush_loop():
+    while True:
+        time.sleep(0.5)
+        try:
+            flush_pending_notes()
+        except Exception as e:
+            print(f"Erreur écriture autosave: {e}", flush=True)
+
+@app.on_event("shutdown")
+def drain_pending_notes():
+    flush_pending_notes(everything=True)
+
+@app.get("/api/notes")
+def list_notes(
+    include_hidden: bool = False,
+    limit: int | None = Query(None, ge=1, le=500),
+    cursor: str | None = None,
+    user: dict = Depends(get_current_user),
+):
+    flush_pending_notes(user["id"])
+    if limit is not None:
+        return _list_notes_page(user["id"], include_hidden, limit, cursor)
+    with db_session() as db:
+        hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
+        rows = db.execute(
+            f"""
+            SELECT * FROM notes
+            WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
+            ORDER BY COALESCE(is_pinned,0) DESC, COALESCE(is_favorite,0) DESC, updated_at DESC
+            """,
+            (user["id"],)
+        ).fetchall()
+        payload = _serialize_notes(rows, db)
     return payload
 
+def _encode_notes_cursor(row: sqlite3.Row) -> str:
+    key = [row["is_pinned"], row["is_favorite"], row["updated_at"], row["id"]]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+def _decode_notes_cursor(cursor: str):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        is_pinned, is_favorite, updated_at, note_id = key
+        return int(is_pinned), int(is_favorite), str(updated_at), str(note_id)
+    except Exception:
+        raise HTTPException(400, "Curseur invalide")
+
+def _list_notes_page(user_id: str, include_hidden: bool, limit: int, cursor: str | None):
+    """
+    Pagination keyset: parcourt idx_notes_user_order dans l'ordre épinglé/favori/updated_at,
+    une page profonde coûte autant que la première. init_db garantit user_id et les flags non NULL.
+    """
+    hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
+    cursor_clause = ""
+    params = [user_id]
+    if cursor:
+        cursor_clause = "AND (is_pinned, is_favorite, updated_at, id) < (?,?,?,?)"
+        params.extend(_decode_notes_cursor(cursor))
+    params.append(limit + 1)
+    with db_session() as db:
+        rows = db.execute(
+            f"""
+            SELECT * FROM notes INDEXED BY idx_notes_user_order
+            WHERE user_id=? {hidden_clause} {cursor_clause}
+            ORDER BY is_pinned DESC, is_favorite DESC, updated_at DESC, id DESC
+            LIMIT ?
+            """,
+            params
+        ).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        payload = _serialize_notes(rows, db)
+    return {
+        "notes": payload,
+        "next_cursor": _encode_notes_cursor(rows[-1]) if has_more else None,
+    }
+
 @app.get("/api/notes/search")
 def search_notes(q: str = Query(""), include_hidden: bool = False, user: dict = Depends(get_current_user)):
-    query = q.strip()
-    if not query:
+    flush_pending_notes(user["id"])
+    match = build_fts_query(q.strip())
+    if not match:
         return []
-    like = f"%{query}%"
-    db = get_db()
-    hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
-    rows = db.execute(
-        f"""
-        SELECT * FROM notes
-        WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
-          AND (title LIKE ? COLLATE NOCASE OR content LIKE ? COLLATE NOCASE)
-        ORDER BY COALESCE(is_pinned,0) DESC, COALESCE(is_favorite,0) DESC, updated_at DESC
-        LIMIT 50
-        """,
-        (user["id"], like, like)
-    ).fetchall()
-    payload = [_serialize_note(r, db) for r in rows]
-    db.close()
+    with db_session() as db:
+        hidden_clause = "" if include_hidden else "AND COALESCE(n.is_hidden, 0) = 0"
+        # bm25: un match dans le titre pèse 10x plus qu'un match dans le contenu
+        rows = db.execute(
+            f"""
+            SELECT n.*,
+                   bm25(notes_fts, 10.0, 1.0) AS rank,
+                   highlight(notes_fts, 0, :mark_start, :mark_end) AS title_highlight,
+                   snippet(notes_fts, 1, :mark_start, :mark_end, '…', 16) AS snippet
+            FROM notes_fts
+            JOIN notes n ON n.rowid = notes_fts.rowid
+            WHERE notes_fts MATCH :match
+              AND (n.user_id=:user_id OR n.user_id IS NULL) {hidden_clause}
+            ORDER BY rank
+            LIMIT 50
+            """,
+            {"match": match, "user_id": user["id"], "mark_start": FTS_MARK_START, "mark_end": FTS_MARK_END}
+        ).fetchall()
+        payload = _serialize_notes(rows, db)
+    for note in payload:
+        note["title_highlight"] = render_fts_markup(note.get("title_highlight"))
+        note["snippet"] = render_fts_markup(note.get("snippet"))
     return payload
 
 @app.get("/api/notes/by-title")
@@ -591,156 +2066,357 @@ def get_note_by_title(
     include_hidden: bool = True,
     user: dict = Depends(get_current_user),
 ):
-    db = get_db()
-    hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
-    row = db.execute(
-        f"""
-        SELECT * FROM notes
-        WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
-          AND LOWER(TRIM(title)) = LOWER(TRIM(?))
-        ORDER BY updated_at DESC
-        LIMIT 1
-        """,
-        (user["id"], title)
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    payload = _serialize_note(row, db)
-    db.close()
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
+        row = db.execute(
+            f"""
+            SELECT * FROM notes
+            WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
+              AND title_key = ?
+            ORDER BY updated_at DESC
+            LIMIT 1
+            """,
+            (user["id"], normalize_title(title))
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        payload = _serialize_note(row, db)
     return payload
 
+@app.post("/api/notes/by-title/batch")
+def get_notes_by_titles(data: NoteTitlesLookup, user: dict = Depends(get_current_user)):
+    """Résout d'un coup les liens d'une note: {titre demandé: {id, title, ...} ou null}."""
+    flush_pending_notes(user["id"])
+    keys = {title: normalize_title(title) for title in data.titles}
+    with db_session() as db:
+        hidden_clause = "" if data.include_hidden else "AND COALESCE(is_hidden, 0) = 0"
+        rows = db.execute(
+            f"""
+            SELECT id, title, title_key, updated_at, is_hidden, pin_hash FROM notes
+            WHERE (user_id=? OR user_id IS NULL) {hidden_clause}
+              AND title_key IN (SELECT value FROM json_each(?))
+            ORDER BY updated_at ASC
+            """,
+            (user["id"], json.dumps(sorted(set(keys.values()))))
+        ).fetchall()
+    # Plus récente en dernier: elle écrase les homonymes, comme LIMIT 1 dans /by-title
+    by_key = {
+        row["title_key"]: {
+            "id": row["id"],
+            "title": row["title"],
+            "updated_at": row["updated_at"],
+            "is_hidden": int(row["is_hidden"] or 0),
+            "is_locked": bool(row["pin_hash"]),
+        }
+        for row in rows
+    }
+    return {title: by_key.get(key) for title, key in keys.items()}
+
+@app.get("/api/notes/titles")
+def autocomplete_note_titles(
+    prefix: str = Query(""),
+    limit: int = Query(20, ge=1, le=100),
+    include_hidden: bool = True,
+    user: dict = Depends(get_current_user),
+):
+    flush_pending_notes(user["id"])
+    key = normalize_title(prefix)
+    with db_session() as db:
+        hidden_clause = "" if include_hidden else "AND COALESCE(is_hidden, 0) = 0"
+        # Intervalle [préfixe, préfixe + U+10FFFF) : parcours de idx_notes_user_title_key, pas de LIKE
+        rows = db.execute(
+            f"""
+            SELECT id, title FROM notes
+            WHERE user_id=? AND title_key >= ? AND title_key < ? {hidden_clause}
+            ORDER BY title_key ASC
+            LIMIT ?
+            """,
+            (user["id"], key, key + "\U0010ffff", limit)
+        ).fetchall()
+    return [{"id": row["id"], "title": row["title"]} for row in rows]
+
+@app.get("/api/notes/changes")
+def note_changes(
+    since: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=2000),
+    include_hidden: bool = False,
+    user: dict = Depends(get_current_user),
+):
+    """
+    Sync delta: notes créées/modifiées et ids supprimés depuis le curseur `since`.
+    Relancer avec le `cursor` retourné tant que `has_more` est vrai.
+    """
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        rows = db.execute(
+            "SELECT * FROM notes WHERE user_id=? AND change_seq > ? ORDER BY change_seq ASC LIMIT ?",
+            (user["id"], since, limit)
+        ).fetchall()
+        tombstones = db.execute(
+            "SELECT note_id, change_seq FROM note_tombstones WHERE user_id=? AND change_seq > ? ORDER BY change_seq ASC LIMIT ?",
+            (user["id"], since, limit)
+        ).fetchall()
+        changes = sorted(
+            [(r["change_seq"], r, None) for r in rows] + [(t["change_seq"], None, t["note_id"]) for t in tombstones],
+            key=lambda change: change[0]
+        )
+        has_more = len(changes) > limit or len(rows) == limit or len(tombstones) == limit
+        changes = changes[:limit]
+        cursor = changes[-1][0] if changes else since
+
+        updated_rows = []
+        deleted = []
+        for _, row, deleted_id in changes:
+            if row is None:
+                deleted.append(deleted_id)
+            elif not include_hidden and row["is_hidden"]:
+                # Une note masquée disparaît de la liste par défaut: le client la retire
+                deleted.append(row["id"])
+            else:
+                updated_rows.append(row)
+        payload = _serialize_notes(updated_rows, db)
+    return {"notes": payload, "deleted": deleted, "cursor": cursor, "has_more": has_more}
+
 @app.post("/api/notes")
 def create_note(note: NoteIn, hidden: bool = False, user: dict = Depends(get_current_user)):
-    db = get_db()
-    nid = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
-    db.execute(
-        """
-        INSERT INTO notes (
-            id, title, content, updated_at, created_at, user_id,
-            is_hidden, is_pinned, is_favorite
-        ) VALUES (?,?,?,?,?,?,?,?,?)
-        """,
-        (nid, note.title, note.content, now, now, user["id"], 1 if hidden else 0, 0, 0)
-    )
-    sync_note_tags(db, nid, user["id"], note.title, note.content)
-    db.commit()
-    row = db.execute("SELECT * FROM notes WHERE id=?", (nid,)).fetchone()
-    payload = _serialize_note(row, db)
-    db.close()
+    with db_session() as db:
+        nid = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        stored, codec = encode_note_content(note.content)
+        db.execute(
+            """
+            INSERT INTO notes (
+                id, title, title_key, content, content_codec, updated_at, created_at, user_id,
+                is_hidden, is_pinned, is_favorite
+            ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (nid, note.title, normalize_title(note.title), stored, codec, now, now, user["id"], 1 if hidden else 0, 0, 0)
+        )
+        sync_note_tags(db, nid, user["id"], note.title, note.content)
+        sync_note_links(db, nid, user["id"], note.content)
+        record_note_revision(db, nid, note.title, note.content, now)
+        db.commit()
+        row = db.execute("SELECT * FROM notes WHERE id=?", (nid,)).fetchone()
+        payload = _serialize_note(row, db)
     return payload
 
-@app.get("/api/notes/{note_id}")
-def get_note(note_id: str, user: dict = Depends(get_current_user)):
+NOTE_BATCH_MAX_OPS = 1000
+
+@app.post("/api/notes/batch")
+def batch_notes(data: NoteBatch, user: dict = Depends(get_current_user)):
+    """
+    Applique une liste d'opérations en une seule transaction, regroupées par type
+    (create, update, color, pin, favorite puis delete). Résultat par opération, dans l'ordre reçu.
+    """
+    flush_pending_notes(user["id"])
+    if len(data.ops) > NOTE_BATCH_MAX_OPS:
+        raise HTTPException(400, f"Maximum {NOTE_BATCH_MAX_OPS} opérations par lot")
     db = get_db()
-    row = db.execute(
-        "SELECT * FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not row:
+    try:
+        referenced = [op.id for op in data.ops if op.op != "create" and op.id]
+        state = {
+            row["id"]: {"is_pinned": int(row["is_pinned"] or 0), "is_favorite": int(row["is_favorite"] or 0)}
+            for row in db.execute(
+                """
+                SELECT id, is_pinned, is_favorite FROM notes
+                WHERE id IN (SELECT value FROM json_each(?)) AND (user_id=? OR user_id IS NULL)
+                """,
+                (json.dumps(referenced), user["id"])
+            ).fetchall()
+        }
+        now = datetime.utcnow().isoformat()
+        results = []
+        creates, updates, colors, pins, favorites, deletes = [], [], [], [], [], []
+        for index, op in enumerate(data.ops):
+            result = {"index": index, "op": op.op, "id": op.id, "ok": True}
+            results.append(result)
+            if op.op == "create":
+                result["id"] = str(uuid.uuid4())
+                creates.append((result["id"], op))
+            elif op.op not in ("update", "delete", "color", "pin", "favorite"):
+                result.update(ok=False, error="Opération inconnue")
+            elif op.id not in state:
+                result.update(ok=False, error="Note introuvable")
+            elif op.op == "update":
+                updates.append((op.id, op))
+                result["updated_at"] = now
+            elif op.op == "delete":
+                deletes.append(op.id)
+                state.pop(op.id)
+            elif op.op == "color":
+                colors.append(((op.color_tag or "").strip() or None, now, op.id))
+            else:
+                field = "is_pinned" if op.op == "pin" else "is_favorite"
+                new_val = int(op.value) if op.value is not None else 1 - state[op.id][field]
+                state[op.id][field] = new_val
+                (pins if op.op == "pin" else favorites).append((new_val, op.id))
+                result[field] = new_val == 1
+
+        if creates:
+            db.executemany(
+                """
+                INSERT INTO notes (
+                    id, title, title_key, content, content_codec, updated_at, created_at, user_id,
+                    is_hidden, is_pinned, is_favorite
+                ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
+                """,
+                [
+                    (
+                        nid, op.title, normalize_title(op.title), *encode_note_content(op.content),
+                        now, now, user["id"], 1 if op.hidden else 0, 0, 0,
+                    )
+                    for nid, op in creates
+                ]
+            )
+        if updates:
+            db.executemany(
+                "UPDATE notes SET title=?, title_key=?, content=?, content_codec=?, updated_at=? WHERE id=?",
+                [(op.title, normalize_title(op.title), *encode_note_content(op.content), now, nid) for nid, op in updates]
+            )
+        for nid, op in creates + updates:
+            sync_note_tags(db, nid, user["id"], op.title, op.content)
+            sync_note_links(db, nid, user["id"], op.content)
+            record_note_revision(db, nid, op.title, op.content, now)
+        if colors:
+            db.executemany("UPDATE notes SET color_tag=?, updated_at=? WHERE id=?", colors)
+        if pins:
+            db.executemany("UPDATE notes SET is_pinned=? WHERE id=?", pins)
+        if favorites:
+            db.executemany("UPDATE notes SET is_favorite=? WHERE id=?", favorites)
+        if deletes:
+            deleted_ids = json.dumps(deletes)
+            attachments = db.execute(
+                "SELECT stored_filename FROM note_attachments WHERE note_id IN (SELECT value FROM json_each(?)) AND user_id=?",
+                (deleted_ids, user["id"])
+            ).fetchall()
+            params = [(nid,) for nid in deletes]
+            db.executemany("DELETE FROM note_attachments WHERE note_id=?", params)
+            db.executemany("DELETE FROM note_tags WHERE note_id=?", params)
+            db.executemany("DELETE FROM note_links WHERE source_id=?", params)
+            db.executemany("DELETE FROM note_revisions WHERE note_id=?", params)
+            db.executemany("DELETE FROM notes WHERE id=?", params)
+        db.commit()
+    finally:
         db.close()
-        raise HTTPException(404, "Note introuvable")
-    payload = _serialize_note(row, db)
-    db.close()
+
+    if deletes:
+        for attachment in attachments:
+            path = NOTE_ATTACHMENTS_DIR / attachment["stored_filename"]
+            if path.exists():
+                path.unlink()
+    return {"results": results}
+
+@app.get("/api/notes/{note_id}")
+def get_note(note_id: str, user: dict = Depends(get_current_user)):
+    # Lue avant la base: une sauvegarde écrite entre les deux ne peut pas être manquée
+    pending = get_pending_note(note_id)
+    with db_session() as db:
+        row = db.execute(
+            "SELECT * FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        payload = _serialize_note(row, db)
+    if pending:
+        payload.update(title=pending["title"], content=pending["content"],
+                       updated_at=max(payload["updated_at"] or "", pending["updated_at"]))
+        payload["tags"] = extract_tags_from_text(pending["title"], pending["content"])
     return payload
 
 @app.put("/api/notes/{note_id}")
 def update_note(note_id: str, note: NoteIn, user: dict = Depends(get_current_user)):
-    db = get_db()
-    now = datetime.utcnow().isoformat()
-    cur = db.execute(
-        "UPDATE notes SET title=?, content=?, updated_at=? WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note.title, note.content, now, note_id, user["id"])
-    )
-    if cur.rowcount == 0:
-        db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+    if not row:
         raise HTTPException(404, "Note introuvable")
-    sync_note_tags(db, note_id, user["id"], note.title, note.content)
-    db.commit()
-    db.close()
+    now = datetime.utcnow().isoformat()
+    buffer_note_write(note_id, user["id"], note.title, note.content, now)
     return {"id": note_id, "updated_at": now}
 
 @app.put("/api/notes/{note_id}/color")
 def update_note_color(note_id: str, data: NoteColorUpdate, user: dict = Depends(get_current_user)):
-    db = get_db()
-    now = datetime.utcnow().isoformat()
-    color_tag = (data.color_tag or "").strip() or None
-    cur = db.execute(
-        "UPDATE notes SET color_tag=?, updated_at=? WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (color_tag, now, note_id, user["id"])
-    )
-    if cur.rowcount == 0:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    db.commit()
-    row = db.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
-    payload = _serialize_note(row, db)
-    db.close()
+    with db_session() as db:
+        now = datetime.utcnow().isoformat()
+        color_tag = (data.color_tag or "").strip() or None
+        cur = db.execute(
+            "UPDATE notes SET color_tag=?, updated_at=? WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (color_tag, now, note_id, user["id"])
+        )
+        if cur.rowcount == 0:
+            raise HTTPException(404, "Note introuvable")
+        db.commit()
+        row = db.execute("SELECT * FROM notes WHERE id=?", (note_id,)).fetchone()
+        payload = _serialize_note(row, db)
     return payload
 
 @app.delete("/api/notes/{note_id}")
 def delete_note(note_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    attachments = db.execute(
-        "SELECT stored_filename FROM note_attachments WHERE note_id=? AND user_id=?",
-        (note_id, user["id"])
-    ).fetchall()
+    with db_session() as db:
+        # Propriété vérifiée avant de toucher aux lignes dépendantes (tags, révisions...)
+        if not db.execute(
+            "SELECT 1 FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)", (note_id, user["id"])
+        ).fetchone():
+            raise HTTPException(404, "Note introuvable")
+        attachments = db.execute(
+            "SELECT stored_filename FROM note_attachments WHERE note_id=? AND user_id=?",
+            (note_id, user["id"])
+        ).fetchall()
+        db.execute("DELETE FROM note_attachments WHERE note_id=? AND user_id=?", (note_id, user["id"]))
+        db.execute("DELETE FROM note_tags WHERE note_id=?", (note_id,))
+        db.execute("DELETE FROM note_revisions WHERE note_id=?", (note_id,))
+        cur = db.execute("DELETE FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)", (note_id, user["id"]))
+        db.commit()
+    if cur.rowcount == 0:
+        raise HTTPException(404, "Note introuvable")
+    discard_pending_notes([note_id])
     for attachment in attachments:
         path = NOTE_ATTACHMENTS_DIR / attachment["stored_filename"]
         if path.exists():
             path.unlink()
-    db.execute("DELETE FROM note_attachments WHERE note_id=? AND user_id=?", (note_id, user["id"]))
-    db.execute("DELETE FROM note_tags WHERE note_id=?", (note_id,))
-    cur = db.execute("DELETE FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)", (note_id, user["id"]))
-    db.commit()
-    db.close()
-    if cur.rowcount == 0:
-        raise HTTPException(404, "Note introuvable")
     return {"ok": True}
 
 @app.put("/api/notes/{note_id}/favorite")
 def toggle_note_favorite(note_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute(
-        "SELECT is_favorite FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    new_val = 0 if (row["is_favorite"] or 0) else 1
-    db.execute("UPDATE notes SET is_favorite=? WHERE id=?", (new_val, note_id))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT is_favorite FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        new_val = 0 if (row["is_favorite"] or 0) else 1
+        db.execute("UPDATE notes SET is_favorite=? WHERE id=?", (new_val, note_id))
+        db.commit()
     return {"ok": True, "is_favorite": new_val == 1}
 
 @app.put("/api/notes/{note_id}/pin")
 def toggle_note_pin(note_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute(
-        "SELECT is_pinned FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    new_val = 0 if (row["is_pinned"] or 0) else 1
-    db.execute("UPDATE notes SET is_pinned=? WHERE id=?", (new_val, note_id))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT is_pinned FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        new_val = 0 if (row["is_pinned"] or 0) else 1
+        db.execute("UPDATE notes SET is_pinned=? WHERE id=?", (new_val, note_id))
+        db.commit()
     return {"ok": True, "is_pinned": new_val == 1}
 
 @app.post("/api/notes/{note_id}/lock")
 def lock_note(note_id: str, data: NoteLock, user: dict = Depends(get_current_user)):
     _require_note_pin(data.pin)
-    db = get_db()
-    cur = db.execute(
-        "UPDATE notes SET pin_hash=? WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (hash_pin(data.pin), note_id, user["id"])
-    )
-    db.commit()
-    db.close()
+    with db_session() as db:
+        cur = db.execute(
+            "UPDATE notes SET pin_hash=? WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (hash_pin(data.pin), note_id, user["id"])
+        )
+        db.commit()
     if cur.rowcount == 0:
         raise HTTPException(404, "Note introuvable")
     return {"ok": True}
@@ -748,12 +2424,11 @@ def lock_note(note_id: str, data: NoteLock, user: dict = Depends(get_current_use
 @app.post("/api/notes/{note_id}/unlock")
 def unlock_note(note_id: str, data: NoteLock, user: dict = Depends(get_current_user)):
     _require_note_pin(data.pin)
-    db = get_db()
-    row = db.execute(
-        "SELECT pin_hash FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT pin_hash FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
     if not row:
         raise HTTPException(404, "Note introuvable")
     if not row["pin_hash"]:
@@ -765,79 +2440,101 @@ def unlock_note(note_id: str, data: NoteLock, user: dict = Depends(get_current_u
 @app.post("/api/notes/{note_id}/remove-lock")
 def remove_note_lock(note_id: str, data: NoteLock, user: dict = Depends(get_current_user)):
     _require_note_pin(data.pin)
-    db = get_db()
-    row = db.execute(
-        "SELECT pin_hash FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    if not row["pin_hash"]:
-        db.close()
-        return {"ok": True}
-    if hash_pin(data.pin) != row["pin_hash"]:
-        db.close()
-        raise HTTPException(401, "PIN incorrect")
-    db.execute("UPDATE notes SET pin_hash=NULL WHERE id=?", (note_id,))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            "SELECT pin_hash FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        if not row["pin_hash"]:
+            return {"ok": True}
+        if hash_pin(data.pin) != row["pin_hash"]:
+            raise HTTPException(401, "PIN incorrect")
+        db.execute("UPDATE notes SET pin_hash=NULL WHERE id=?", (note_id,))
+        db.commit()
     return {"ok": True}
 
 @app.get("/api/notes/{note_id}/backlinks")
 def note_backlinks(note_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    current = db.execute(
-        "SELECT id, title FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not current:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-
-    title = (current["title"] or "").strip()
-    if not title:
-        db.close()
-        return []
-
-    encoded_title = quote(title, safe="")
-    like_wikilink = f"%[[{title}]]%"
-    like_uri_plain = f"%toutienote://note/{title}%"
-    like_uri_encoded = f"%toutienote://note/{encoded_title}%"
-
-    rows = db.execute(
-        """
-        SELECT * FROM notes
-        WHERE id <> ?
-          AND (user_id=? OR user_id IS NULL)
-          AND (
-              content LIKE ? COLLATE NOCASE
-              OR content LIKE ? COLLATE NOCASE
-              OR content LIKE ? COLLATE NOCASE
-          )
-        ORDER BY COALESCE(is_pinned,0) DESC, COALESCE(is_favorite,0) DESC, updated_at DESC
-        """,
-        (note_id, user["id"], like_wikilink, like_uri_plain, like_uri_encoded)
-    ).fetchall()
-    payload = [_serialize_note(r, db) for r in rows]
-    db.close()
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        current = db.execute(
+            "SELECT id, title_key FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not current:
+            raise HTTPException(404, "Note introuvable")
+
+        target_key = current["title_key"]
+        if not target_key:
+            return []
+
+        # Les liens sont indexés par titre normalisé: un renommage n'a rien à réécrire
+        rows = db.execute(
+            """
+            SELECT n.* FROM note_links l
+            JOIN notes n ON n.id = l.source_id
+            WHERE (l.user_id=? OR l.user_id IS NULL) AND l.target_key=?
+              AND n.id <> ?
+              AND (n.user_id=? OR n.user_id IS NULL)
+            ORDER BY COALESCE(n.is_pinned,0) DESC, COALESCE(n.is_favorite,0) DESC, n.updated_at DESC
+            """,
+            (user["id"], target_key, note_id, user["id"])
+        ).fetchall()
+        payload = _serialize_notes(rows, db)
     return payload
 
+@app.get("/api/notes/{note_id}/revisions")
+def list_note_revisions(note_id: str, user: dict = Depends(get_current_user)):
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        note = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not note:
+            raise HTTPException(404, "Note introuvable")
+        rows = db.execute(
+            """
+            SELECT seq, kind, title, created_at, updated_at FROM note_revisions
+            WHERE note_id=?
+            ORDER BY seq DESC
+            """,
+            (note_id,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+@app.get("/api/notes/{note_id}/revisions/{seq}")
+def get_note_revision_content(note_id: str, seq: int, user: dict = Depends(get_current_user)):
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        note = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not note:
+            raise HTTPException(404, "Note introuvable")
+        revision = get_note_revision(db, note_id, seq)
+    if not revision:
+        raise HTTPException(404, "Révision introuvable")
+    return revision
+
 @app.get("/api/tags")
 def list_tags(user: dict = Depends(get_current_user)):
-    db = get_db()
-    rows = db.execute(
-        """
-        SELECT t.name, COUNT(nt.note_id) AS note_count
-        FROM tags t
-        LEFT JOIN note_tags nt ON nt.tag_id = t.id
-        WHERE t.user_id = ?
-        GROUP BY t.id, t.name
-        ORDER BY LOWER(t.name) ASC
-        """,
-        (user["id"],)
-    ).fetchall()
-    db.close()
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        rows = db.execute(
+            """
+            SELECT t.name, COUNT(nt.note_id) AS note_count
+            FROM tags t
+            LEFT JOIN note_tags nt ON nt.tag_id = t.id
+            WHERE t.user_id = ?
+            GROUP BY t.id, t.name
+            ORDER BY LOWER(t.name) ASC
+            """,
+            (user["id"],)
+        ).fetchall()
     return [{"name": row["name"], "note_count": row["note_count"]} for row in rows]
 
 @app.post("/api/tags")
@@ -846,127 +2543,122 @@ def create_tag(data: dict, user: dict = Depends(get_current_user)):
     name = normalize_tag(raw_name)
     if not name:
         raise HTTPException(400, "Nom de tag invalide")
-    db = get_db()
-    existing = db.execute(
-        "SELECT id, name FROM tags WHERE user_id=? AND name=?",
-        (user["id"], name)
-    ).fetchone()
-    if existing:
-        db.close()
-        return {"id": existing["id"], "name": existing["name"]}
-    tag_id = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
-    db.execute(
-        "INSERT INTO tags (id, user_id, name, created_at) VALUES (?,?,?,?)",
-        (tag_id, user["id"], name, now)
-    )
-    db.commit()
-    db.close()
+    with db_session() as db:
+        existing = db.execute(
+            "SELECT id, name FROM tags WHERE user_id=? AND name=?",
+            (user["id"], name)
+        ).fetchone()
+        if existing:
+            return {"id": existing["id"], "name": existing["name"]}
+        tag_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        db.execute(
+            "INSERT INTO tags (id, user_id, name, created_at) VALUES (?,?,?,?)",
+            (tag_id, user["id"], name, now)
+        )
+        db.commit()
     return {"id": tag_id, "name": name}
 
 @app.put("/api/notes/{note_id}/tags")
 def update_note_tags(note_id: str, data: NoteTagsUpdate, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute(
-        "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    set_note_tags(db, note_id, user["id"], data.tags)
-    db.commit()
-    tags = get_note_tags(db, note_id)
-    db.close()
+    flush_pending_notes(user["id"])
+    with db_session() as db:
+        row = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Note introuvable")
+        if set_note_tags(db, note_id, user["id"], data.tags):
+            bump_note_change(db, note_id)
+            db.commit()
+        tags = get_note_tags(db, note_id)
     return {"ok": True, "tags": tags}
 
 @app.get("/api/notes/{note_id}/attachments")
 def list_note_attachments(note_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    note = db.execute(
-        "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not note:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-    rows = db.execute(
-        """
-        SELECT * FROM note_attachments
-        WHERE note_id=? AND user_id=?
-        ORDER BY created_at ASC
-        """,
-        (note_id, user["id"])
-    ).fetchall()
-    db.close()
+    with db_session() as db:
+        note = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user["id"])
+        ).fetchone()
+        if not note:
+            raise HTTPException(404, "Note introuvable")
+        rows = db.execute(
+            """
+            SELECT * FROM note_attachments
+            WHERE note_id=? AND user_id=?
+            ORDER BY created_at ASC
+            """,
+            (note_id, user["id"])
+        ).fetchall()
     return [serialize_note_attachment(row) for row in rows]
 
-@app.post("/api/notes/{note_id}/attachments")
-async def upload_note_attachment(note_id: str, file: UploadFile = File(...), user: dict = Depends(get_current_user)):
-    db = get_db()
-    note = db.execute(
-        "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
-        (note_id, user["id"])
-    ).fetchone()
-    if not note:
-        db.close()
-        raise HTTPException(404, "Note introuvable")
-
-    original_name = Path(file.filename or "attachment.bin").name
-    ext = Path(original_name).suffix.lower()
-    attachment_id = str(uuid.uuid4())
-    stored_filename = f"{attachment_id}{ext}"
-    dest = NOTE_ATTACHMENTS_DIR / stored_filename
-
-    data = await file.read()
-    if not data:
-        db.close()
-        raise HTTPException(400, "Fichier vide")
-
-    with open(dest, "wb") as output:
-        output.write(data)
-
-    content_type = (file.content_type or "").lower()
-    if content_type.startswith("image/"):
-        media_type = "image"
-    elif content_type.startswith("video/"):
-        media_type = "video"
-    else:
-        media_type = "file"
+def _store_note_attachment(note_id: str, user_id: str, file: UploadFile):
+    with db_session() as db:
+        note = db.execute(
+            "SELECT id FROM notes WHERE id=? AND (user_id=? OR user_id IS NULL)",
+            (note_id, user_id)
+        ).fetchone()
+        if not note:
+            raise HTTPException(404, "Note introuvable")
+
+        original_name = Path(file.filename or "attachment.bin").name
+        ext = Path(original_name).suffix.lower()
+        attachment_id = str(uuid.uuid4())
+        stored_filename = f"{attachment_id}{ext}"
+        dest = NOTE_ATTACHMENTS_DIR / stored_filename
+
+        with open(dest, "wb") as output:
+            shutil.copyfileobj(file.file, output)
+        size = dest.stat().st_size
+        metric_inc("upload_bytes_total", size, kind="attachment")
+        if not size:
+            dest.unlink()
+            raise HTTPException(400, "Fichier vide")
+
+        content_type = (file.content_type or "").lower()
+        if content_type.startswith("image/"):
+            media_type = "image"
+        elif content_type.startswith("video/"):
+            media_type = "video"
+        else:
+            media_type = "file"
 
-    now = datetime.utcnow().isoformat()
-    db.execute(
-        """
-        INSERT INTO note_attachments (
-            id, note_id, user_id, filename, stored_filename, media_type, size, created_at
-        ) VALUES (?,?,?,?,?,?,?,?)
-        """,
-        (attachment_id, note_id, user["id"], original_name, stored_filename, media_type, len(data), now)
-    )
-    db.commit()
-    row = db.execute("SELECT * FROM note_attachments WHERE id=?", (attachment_id,)).fetchone()
-    db.close()
+        now = datetime.utcnow().isoformat()
+        db.execute(
+            """
+            INSERT INTO note_attachments (
+                id, note_id, user_id, filename, stored_filename, media_type, size, created_at
+            ) VALUES (?,?,?,?,?,?,?,?)
+            """,
+            (attachment_id, note_id, user_id, original_name, stored_filename, media_type, size, now)
+        )
+        db.commit()
+        row = db.execute("SELECT * FROM note_attachments WHERE id=?", (attachment_id,)).fetchone()
     return serialize_note_attachment(row)
 
+@app.post("/api/notes/{note_id}/attachments")
+async def upload_note_attachment(note_id: str, file: UploadFile = File(...), user: dict = Depends(get_current_user)):
+    return await run_media(_store_note_attachment, note_id, user["id"], file)
+
 @app.delete("/api/notes/{note_id}/attachments/{attachment_id}")
 def delete_note_attachment(note_id: str, attachment_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute(
-        """
-        SELECT * FROM note_attachments
-        WHERE id=? AND note_id=? AND user_id=?
-        """,
-        (attachment_id, note_id, user["id"])
-    ).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Piece jointe introuvable")
-    path = NOTE_ATTACHMENTS_DIR / row["stored_filename"]
-    if path.exists():
-        path.unlink()
-    db.execute("DELETE FROM note_attachments WHERE id=?", (attachment_id,))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute(
+            """
+            SELECT * FROM note_attachments
+            WHERE id=? AND note_id=? AND user_id=?
+            """,
+            (attachment_id, note_id, user["id"])
+        ).fetchone()
+        if not row:
+            raise HTTPException(404, "Piece jointe introuvable")
+        path = NOTE_ATTACHMENTS_DIR / row["stored_filename"]
+        if path.exists():
+            path.unlink()
+        db.execute("DELETE FROM note_attachments WHERE id=?", (attachment_id,))
+        db.commit()
     return {"ok": True}
 
 @app.get("/api/notes/attachments/{stored_filename}")
@@ -976,6 +2668,284 @@ def get_note_attachment(stored_filename: str):
         raise HTTPException(404, "Fichier introuvable")
     return FileResponse(str(path))
 
+# ══════════════════════════════════════════════════════════════════════════════
+# JOBS — état partagé entre workers
+# ══════════════════════════════════════════════════════════════════════════════
+# Un job (scan de doublons, recompression...) vit dans la table jobs: n'importe quel worker
+# peut en lire l'état. Il est réclamé par un UPDATE conditionnel, donc par un seul worker;
+# celui-ci publie un heartbeat, et un job dont le heartbeat est périmé peut être repris.
+JOB_HEARTBEAT_SECONDS = 10
+JOB_STALE_SECONDS = 60
+JOB_SAVE_INTERVAL_SECONDS = 0.5
+JOB_RETENTION_HOURS = 24
+
+JOB_RUNNERS = {}
+_local_jobs = set()  # jobs en cours d'exécution dans ce processus
+_local_jobs_lock = threading.Lock()
+
+class Job(dict):
+    """État d'un job. save() le publie dans la table (au plus toutes les JOB_SAVE_INTERVAL_SECONDS)."""
+
+    def __init__(self, job_id: str | None, state: dict):
+        super().__init__(state)
+        self.id = job_id
+        self._saved_at = 0.0
+
+    def save(self, force: bool = False, db: sqlite3.Connection | None = None):
+        """db: connexion déjà tenue par le runner, pour ne pas ouvrir une connexion de débordement."""
+        if self.id is None:  # job local (scan synchrone): rien à publier
+            return
+        now = time.time()
+        if not force and now - self._saved_at < JOB_SAVE_INTERVAL_SECONDS:
+            return
+        self._saved_at = now
+        status = ("error" if self.get("error") else "done") if self.get("done") else "running"
+        with db_session() if db is None else nullcontext(db) as db:
+            db.execute(
+                "UPDATE jobs SET state=?, status=?, heartbeat_at=? WHERE id=? AND worker=?",
+                (json.dumps(self), status, now, self.id, WORKER_ID)
+            )
+            db.commit()
+
+def create_job(kind: str, params: dict, state: dict) -> str:
+    job_id = str(uuid.uuid4())
+    with db_session() as db:
+        db.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'error') AND heartbeat_at < ?",
+            (time.time() - JOB_RETENTION_HOURS * 3600,)
+        )
+        db.execute(
+            "INSERT INTO jobs (id, kind, params, status, state, created_at) VALUES (?,?,?,'queued',?,?)",
+            (job_id, kind, json.dumps(params), json.dumps(state), datetime.utcnow().isoformat())
+        )
+        db.commit()
+    dispatch_job(job_id)
+    return job_id
+
+def _claim_job(job_id: str):
+    now = time.time()
+    with db_session() as db:
+        cur = db.execute(
+            """
+            UPDATE jobs SET status='running', worker=?, heartbeat_at=?
+            WHERE id=? AND (status='queued' OR (status='running' AND heartbeat_at < ?))
+            """,
+            (WORKER_ID, now, job_id, now - JOB_STALE_SECONDS)
+        )
+        db.commit()
+        if cur.rowcount != 1:
+            return None
+        return db.execute("SELECT kind, params, state FROM jobs WHERE id=?", (job_id,)).fetchone()
+
+def _job_heartbeat(job_id: str, stop: threading.Event):
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            with db_session() as db:
+                db.execute("UPDATE jobs SET heartbeat_at=? WHERE id=? AND worker=?", (time.time(), job_id, WORKER_ID))
+                db.commit()
+        except Exception as e:  # base verrouillée...: on réessaie au prochain tick
+            print(f"Erreur heartbeat du job {job_id}: {e}", flush=True)
+
+def run_job(job_id: str) -> bool:
+    # Un heartbeat en retard ne doit pas faire tourner une seconde copie dans ce processus
+    with _local_jobs_lock:
+        if job_id in _local_jobs:
+            return False
+        _local_jobs.add(job_id)
+    try:
+        row = _claim_job(job_id)
+        if row is None:
+            return False
+        job = Job(job_id, json.loads(row["state"]))
+        stop = threading.Event()
+        threading.Thread(target=_job_heartbeat, args=(job_id, stop), daemon=True).start()
+        try:
+            JOB_RUNNERS[row["kind"]](job, **json.loads(row["params"]))
+        except Exception as e:
+            job.update(error=str(e), done=True)
+        finally:
+            stop.set()
+            job.save(force=True)
+        return True
+    finally:
+        with _local_jobs_lock:
+            _local_jobs.discard(job_id)
+
+def dispatch_job(job_id: str):
+    threading.Thread(target=run_job, args=(job_id,), daemon=True).start()
+
+def get_job_state(job_id: str, kind: str):
+    with db_session() as db:
+        row = db.execute("SELECT status, state, heartbeat_at FROM jobs WHERE id=? AND kind=?", (job_id, kind)).fetchone()
+    if not row:
+        return None
+    if row["status"] == "running" and row["heartbeat_at"] < time.time() - JOB_STALE_SECONDS:
+        dispatch_job(job_id)  # worker disparu: on le reprend ici
+    return json.loads(row["state"])
+
+@app.on_event("startup")
+def resume_jobs():
+    # Jobs en file ou orphelins (worker arrêté en cours de route): chaque worker tente, un seul réclame
+    with db_session() as db:
+        rows = db.execute(
+            "SELECT id FROM jobs WHERE status='queued' OR (status='running' AND heartbeat_at < ?)",
+            (time.time() - JOB_STALE_SECONDS,)
+        ).fetchall()
+    for row in rows:
+        dispatch_job(row["id"])
+
+@app.get("/api/admin/jobs")
+def list_jobs(user: dict = Depends(require_admin)):
+    with db_session() as db:
+        rows = db.execute(
+            "SELECT id, kind, status, worker, created_at, heartbeat_at FROM jobs ORDER BY created_at DESC LIMIT 50"
+        ).fetchall()
+    return {"worker": WORKER_ID, "workers": WORKERS, "jobs": [dict(r) for r in rows]}
+
+# ══════════════════════════════════════════════════════════════════════════════
+# ADMIN — COMPRESSION DES NOTES
+# ══════════════════════════════════════════════════════════════════════════════
+
+def _run_recompress(job: Job, vacuum: bool):
+    """Compresse par lots les notes stockées en clair au-dessus du seuil (lignes écrites avant la compression)."""
+    db = get_db()
+    try:
+        job["db_size_before"] = DB_PATH.stat().st_size
+        last_rowid = 0
+        while True:
+            rows = db.execute(
+                """
+                SELECT rowid, content FROM notes
+                WHERE rowid > ? AND content_codec IS NULL AND length(CAST(content AS BLOB)) >= ?
+                ORDER BY rowid LIMIT 200
+                """,
+                (last_rowid, NOTE_COMPRESS_THRESHOLD)
+            ).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1]["rowid"]
+            for row in rows:
+                stored, codec = encode_note_content(row["content"])
+                job["scanned"] += 1
+                if codec is None:
+                    continue
+                # Condition sur le texte lu: une sauvegarde arrivée entre le SELECT et l'UPDATE gagne
+                cur = db.execute(
+                    "UPDATE notes SET content=?, content_codec=? WHERE rowid=? AND content_codec IS NULL AND content=?",
+                    (stored, codec, row["rowid"], row["content"])
+                )
+                if cur.rowcount:
+                    job["compressed"] += 1
+                    job["bytes_before"] += len(row["content"].encode("utf-8"))
+                    job["bytes_after"] += len(stored)
+            db.commit()
+            job["percent"] = min(99, int(job["scanned"] / job["total"] * 100)) if job["total"] else 99
+            job.save(db=db)
+        if vacuum:
+            db.execute("VACUUM")
+        job["db_size_after"] = DB_PATH.stat().st_size
+        job.update(saved_bytes=job["bytes_before"] - job["bytes_after"], percent=100, done=True)
+    except Exception as e:
+        db.rollback()
+        job["error"] = str(e)
+        job["done"] = True
+    finally:
+        db.close()
+
+JOB_RUNNERS["recompress"] = _run_recompress
+
+@app.post("/api/admin/notes/recompress")
+def start_recompress(vacuum: bool = False, user: dict = Depends(require_admin)):
+    with db_session() as db:
+        total = db.execute(
+            "SELECT COUNT(*) FROM notes WHERE content_codec IS NULL AND length(CAST(content AS BLOB)) >= ?",
+            (NOTE_COMPRESS_THRESHOLD,)
+        ).fetchone()[0]
+    job_id = create_job("recompress", {"vacuum": vacuum}, {
+        "total": total, "scanned": 0, "compressed": 0, "percent": 0,
+        "bytes_before": 0, "bytes_after": 0, "saved_bytes": 0,
+        "db_size_before": None, "db_size_after": None, "done": False, "error": None,
+    })
+    return {"job_id": job_id, "total": total}
+
+@app.get("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(404, "Métriques désactivées (TOUTIENOTES_METRICS=1)")
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+def report_startup():
+    startup_report["ready_ms"] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+    print(f"[Démarrage] imports {startup_report['imports_ms']} ms, init_db {startup_report['init_db_ms']} ms, "
+          f"prêt en {startup_report['ready_ms']} ms", flush=True)
+    if WARMUP_ENABLED:
+        threading.Thread(target=_warmup_imaging, daemon=True).start()
+
+@app.get("/api/admin/startup")
+def startup_status(user: dict = Depends(require_admin)):
+    return startup_report
+
+@app.get("/api/admin/db/pool")
+def db_pool_status(user: dict = Depends(require_admin)):
+    with _db_pool_lock:
+        stats = dict(db_pool_stats)
+    stats["reuse_ratio"] = round(stats["reused"] / stats["checkouts"], 3) if stats["checkouts"] else None
+    stats["pragmas"] = list(SQLITE_PRAGMAS)
+    return stats
+
+@app.get("/api/admin/auth/cache")
+def auth_cache_status(user: dict = Depends(require_admin)):
+    with _auth_cache_lock:
+        stats = dict(auth_cache_stats)
+        stats["entries"] = len(_auth_cache)
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else None
+    return stats
+
+@app.get("/api/admin/traces")
+def list_traces(limit: int = Query(50, ge=1, le=TRACE_BUFFER_SIZE), user: dict = Depends(require_admin)):
+    if not TRACE_ENABLED:
+        raise HTTPException(404, "Mode trace désactivé (TOUTIENOTES_TRACE=1)")
+    with _trace_buffer_lock:
+        traces = list(_trace_buffer)[-limit:]
+    keys = ("id", "method", "path", "route", "status", "reason", "started_at", "total_ms", "sql_ms", "query_count")
+    return [{k: t[k] for k in keys} for t in reversed(traces)]
+
+@app.get("/api/admin/traces/{trace_id}")
+def get_trace(trace_id: str, user: dict = Depends(require_admin)):
+    with _trace_buffer_lock:
+        trace = next((t for t in _trace_buffer if t["id"] == trace_id), None)
+    if trace is None:
+        raise HTTPException(404, "Trace introuvable")
+    return trace
+
+@app.get("/api/admin/db/snapshot")
+def db_snapshot_status(user: dict = Depends(require_admin)):
+    return {**snapshot_state, "db_path": str(DB_PATH), "snapshot_path": str(SNAPSHOT_PATH)}
+
+@app.post("/api/admin/db/snapshot")
+def take_db_snapshot(user: dict = Depends(require_admin)):
+    if not snapshot_db():
+        raise HTTPException(400, "Mode base locale désactivé (TOUTIENOTES_LOCAL_DB)")
+    return snapshot_state
+
+@app.on_event("shutdown")
+def stop_scan_pool():
+    _discard_scan_pool()
+
+@app.on_event("shutdown")
+def final_db_snapshot():
+    # Enregistré après drain_pending_notes: le snapshot final contient les autosaves en attente
+    snapshot_db()
+
+@app.get("/api/admin/notes/recompress/status")
+def recompress_status(job_id: str, user: dict = Depends(require_admin)):
+    state = get_job_state(job_id, "recompress")
+    if state is None:
+        raise HTTPException(404, "Job not found")
+    return state
+
 # ══════════════════════════════════════════════════════════════════════════════
 # VAULT — PIN
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1028,16 +2998,16 @@ def change_pin(data: PinChange, user: dict = Depends(get_current_user)):
 
 @app.get("/api/vault/albums")
 def list_albums(user: dict = Depends(get_current_user)):
-    db = get_db()
-    rows = db.execute("SELECT * FROM albums WHERE user_id=? OR user_id IS NULL ORDER BY sort_order ASC, created_at DESC", (user["id"],)).fetchall()
-    db.close()
+    with db_session() as db:
+        rows = db.execute("""
+            SELECT a.*, (SELECT COUNT(*) FROM photos p WHERE p.album_id = a.id) AS photo_count
+            FROM albums a
+            WHERE a.user_id=? OR a.user_id IS NULL
+            ORDER BY a.sort_order ASC, a.created_at DESC
+        """, (user["id"],)).fetchall()
     albums = []
     for r in rows:
         album = dict(r)
-        db2 = get_db()
-        count = db2.execute("SELECT COUNT(*) as cnt FROM photos WHERE album_id=?", (album["id"],)).fetchone()["cnt"]
-        db2.close()
-        album["photo_count"] = count
         album["is_locked"] = bool(album.get("pin_hash"))
         album.pop("pin_hash", None)
         albums.append(album)
@@ -1045,29 +3015,26 @@ def list_albums(user: dict = Depends(get_current_user)):
 
 @app.post("/api/vault/albums")
 def create_album(data: AlbumCreate, user: dict = Depends(get_current_user)):
-    db = get_db()
-    album_id = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
-    db.execute("INSERT INTO albums (id, name, cover_url, created_at, user_id) VALUES(?,?,?,?,?)",
-               (album_id, data.name, None, now, user["id"]))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        album_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        db.execute("INSERT INTO albums (id, name, cover_url, created_at, user_id) VALUES(?,?,?,?,?)",
+                   (album_id, data.name, None, now, user["id"]))
+        db.commit()
     return {"id": album_id, "name": data.name, "cover_url": None, "created_at": now, "photo_count": 0, "is_locked": False}
 
 @app.post("/api/vault/albums/{album_id}/lock")
 def lock_album(album_id: str, data: AlbumLock, user: dict = Depends(get_current_user)):
-    db = get_db()
-    hashed = hash_pin(data.pin)
-    db.execute("UPDATE albums SET pin_hash=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (hashed, album_id, user["id"]))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        hashed = hash_pin(data.pin)
+        db.execute("UPDATE albums SET pin_hash=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (hashed, album_id, user["id"]))
+        db.commit()
     return {"ok": True}
 
 @app.post("/api/vault/albums/{album_id}/verify-lock")
 def verify_album_lock(album_id: str, data: AlbumLock, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute("SELECT pin_hash FROM albums WHERE id=?", (album_id,)).fetchone()
-    db.close()
+    with db_session() as db:
+        row = db.execute("SELECT pin_hash FROM albums WHERE id=?", (album_id,)).fetchone()
     if not row or not row["pin_hash"]:
         return {"ok": True}
     if hash_pin(data.pin) != row["pin_hash"]:
@@ -1076,53 +3043,47 @@ def verify_album_lock(album_id: str, data: AlbumLock, user: dict = Depends(get_c
 
 @app.delete("/api/vault/albums/{album_id}")
 def delete_album(album_id: str, user: dict = Depends(get_current_user)):
-    db = get_db()
-    photos = db.execute("SELECT filename FROM photos WHERE album_id=?", (album_id,)).fetchall()
-    for p in photos:
-        path = VAULT_DIR / p["filename"]
-        if path.exists():
-            path.unlink()
-    db.execute("DELETE FROM photos WHERE album_id=?", (album_id,))
-    db.execute("DELETE FROM albums WHERE id=? AND (user_id=? OR user_id IS NULL)", (album_id, user["id"]))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        photos = db.execute("SELECT filename FROM photos WHERE album_id=?", (album_id,)).fetchall()
+        for p in photos:
+            path = VAULT_DIR / p["filename"]
+            if path.exists():
+                path.unlink()
+        db.execute("DELETE FROM photos WHERE album_id=?", (album_id,))
+        db.execute("DELETE FROM albums WHERE id=? AND (user_id=? OR user_id IS NULL)", (album_id, user["id"]))
+        db.commit()
     return {"ok": True}
 
 @app.put("/api/vault/albums/reorder")
 def reorder_albums(data: AlbumReorder, user: dict = Depends(get_current_user)):
-    db = get_db()
-    for i, aid in enumerate(data.album_ids):
-        db.execute("UPDATE albums SET sort_order=? WHERE id=?", (i, aid))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        for i, aid in enumerate(data.album_ids):
+            db.execute("UPDATE albums SET sort_order=? WHERE id=?", (i, aid))
+        db.commit()
     return {"ok": True}
 
 @app.put("/api/vault/albums/{album_id}")
 def rename_album(album_id: str, data: AlbumCreate, user: dict = Depends(get_current_user)):
-    db = get_db()
-    db.execute("UPDATE albums SET name=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (data.name, album_id, user["id"]))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        db.execute("UPDATE albums SET name=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (data.name, album_id, user["id"]))
+        db.commit()
     return {"ok": True}
 
 @app.post("/api/vault/albums/{album_id}/unlock")
 def unlock_album(album_id: str, data: AlbumLock, user: dict = Depends(get_current_user)):
-    db = get_db()
-    row = db.execute("SELECT pin_hash FROM albums WHERE id=?", (album_id,)).fetchone()
-    if row and row["pin_hash"] and hash_pin(data.pin) != row["pin_hash"]:
-        db.close()
-        raise HTTPException(401, "PIN incorrect")
-    db.execute("UPDATE albums SET pin_hash=NULL WHERE id=?", (album_id,))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute("SELECT pin_hash FROM albums WHERE id=?", (album_id,)).fetchone()
+        if row and row["pin_hash"] and hash_pin(data.pin) != row["pin_hash"]:
+            raise HTTPException(401, "PIN incorrect")
+        db.execute("UPDATE albums SET pin_hash=NULL WHERE id=?", (album_id,))
+        db.commit()
     return {"ok": True}
 
 @app.put("/api/vault/albums/{album_id}/cover")
 def update_album_cover(album_id: str, data: AlbumCoverUpdate, user: dict = Depends(get_current_user)):
-    db = get_db()
-    db.execute("UPDATE albums SET cover_url=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (data.photo_url, album_id, user["id"]))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        db.execute("UPDATE albums SET cover_url=? WHERE id=? AND (user_id=? OR user_id IS NULL)", (data.photo_url, album_id, user["id"]))
+        db.commit()
     return {"ok": True}
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1131,31 +3092,29 @@ def update_album_cover(album_id: str, data: AlbumCoverUpdate, user: dict = Depen
 
 @app.put("/api/vault/albums/{album_id}/photos/reorder")
 def reorder_photos(album_id: str, data: PhotoReorder, user: dict = Depends(get_current_user)):
-    db = get_db()
-    for i, pid in enumerate(data.photo_ids):
-        db.execute("UPDATE photos SET sort_order=? WHERE id=? AND album_id=?", (i, pid, album_id))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        for i, pid in enumerate(data.photo_ids):
+            db.execute("UPDATE photos SET sort_order=? WHERE id=? AND album_id=?", (i, pid, album_id))
+        db.commit()
     return {"ok": True}
 
 @app.get("/api/vault/photos")
 def list_photos(album_id: str = None, user: dict = Depends(get_current_user)):
-    db = get_db()
-    if album_id:
-        rows = db.execute("""
-            SELECT p.* FROM photos p
-            JOIN albums a ON p.album_id = a.id
-            WHERE p.album_id=? AND (a.user_id=? OR a.user_id IS NULL)
-            ORDER BY COALESCE(p.favorite,0) DESC, p.sort_order ASC, p.created_at DESC
-        """, (album_id, user["id"])).fetchall()
-    else:
-        rows = db.execute("""
-            SELECT p.* FROM photos p
-            JOIN albums a ON p.album_id = a.id
-            WHERE a.user_id=? OR a.user_id IS NULL
-            ORDER BY COALESCE(p.favorite,0) DESC, p.sort_order ASC, p.created_at DESC
-        """, (user["id"],)).fetchall()
-    db.close()
+    with db_session() as db:
+        if album_id:
+            rows = db.execute("""
+                SELECT p.* FROM photos p
+                JOIN albums a ON p.album_id = a.id
+                WHERE p.album_id=? AND (a.user_id=? OR a.user_id IS NULL)
+                ORDER BY COALESCE(p.favorite,0) DESC, p.sort_order ASC, p.created_at DESC
+            """, (album_id, user["id"])).fetchall()
+        else:
+            rows = db.execute("""
+                SELECT p.* FROM photos p
+                JOIN albums a ON p.album_id = a.id
+                WHERE a.user_id=? OR a.user_id IS NULL
+                ORDER BY COALESCE(p.favorite,0) DESC, p.sort_order ASC, p.created_at DESC
+            """, (user["id"],)).fetchall()
 
     photos = []
     for r in rows:
@@ -1172,12 +3131,24 @@ def list_photos(album_id: str = None, user: dict = Depends(get_current_user)):
             photos.append(photo)
     return photos
 
-@app.post("/api/vault/upload")
-async def upload_photo(file: UploadFile = File(...), album_id: str = None, user: dict = Depends(get_current_user)):
+def process_photo_image(path: Path, thumbnail_filename: str):
+    """pHash (photo_hashing, comme partout ailleurs) et miniature WEBP: (phash, miniature), None en cas d'échec."""
+    phash_val = None
+    try:
+        img = Image.open(path)
+        phash_val = compute_phash(path) or None
+        with metric_timer("image_processing_seconds", op="thumbnail"):
+            img.thumbnail((500, 500))
+            img.save(VAULT_DIR / thumbnail_filename, format="WEBP", quality=80)
+        return phash_val, thumbnail_filename
+    except Exception as e:
+        print(f"Erreur traitement image: {e}")
+        return phash_val, None
+
+def _store_uploaded_photo(file: UploadFile, album_id: str, user_id: str):
     if album_id:
-        db = get_db()
-        album = db.execute("SELECT id FROM albums WHERE id=? AND (user_id=? OR user_id IS NULL)", (album_id, user["id"])).fetchone()
-        db.close()
+        with db_session() as db:
+            album = db.execute("SELECT id FROM albums WHERE id=? AND (user_id=? OR user_id IS NULL)", (album_id, user_id)).fetchone()
         if not album:
             raise HTTPException(403, "Album introuvable")
     ext = Path(file.filename).suffix.lower()
@@ -1191,43 +3162,37 @@ async def upload_photo(file: UploadFile = File(...), album_id: str = None, user:
 
     with open(dest, "wb") as f:
         shutil.copyfileobj(file.file, f)
+    metric_inc("upload_bytes_total", dest.stat().st_size, kind="photo")
 
     media_type = 'video' if is_video else 'image'
     thumbnail_filename = None
     phash_val = None
 
     if not is_video:
-        try:
-            img = Image.open(dest)
-            phash_val = compute_phash(dest)
-            img.thumbnail((500, 500))
-            thumbnail_filename = f"thumb_{photo_id}.webp"
-            thumb_dest = VAULT_DIR / thumbnail_filename
-            img.save(thumb_dest, format="WEBP", quality=80)
-        except Exception as e:
-            print(f"Erreur traitement image: {e}")
+        phash_val, thumbnail_filename = process_photo_image(dest, f"thumb_{photo_id}.webp")
 
     duplicate_of = None
     if phash_val:
-        dup = is_duplicate(phash_val)
+        dup = is_duplicate(phash_val, user_id)
         if dup:
             duplicate_of = dup["id"]
 
-    db = get_db()
-    now = datetime.utcnow().isoformat()
-    db.execute("""
-        INSERT INTO photos (id, album_id, filename, thumbnail_filename, media_type, phash, created_at)
-        VALUES(?,?,?,?,?,?,?)
-    """, (photo_id, album_id, filename, thumbnail_filename, media_type, phash_val, now))
-    db.commit()
-
-    if album_id:
-        count = db.execute("SELECT COUNT(*) as cnt FROM photos WHERE album_id=?", (album_id,)).fetchone()["cnt"]
-        if count == 1:
-            db.execute("UPDATE albums SET cover_url=? WHERE id=?", (f"/api/vault/photo/{filename}", album_id))
-            db.commit()
+    with db_session() as db:
+        now = datetime.utcnow().isoformat()
+        db.execute("""
+            INSERT INTO photos (id, album_id, user_id, filename, thumbnail_filename, media_type, phash, created_at)
+            VALUES(?,?,?,?,?,?,?,?)
+        """, (photo_id, album_id, user_id, filename, thumbnail_filename, media_type, phash_val, now))
+        db.execute("DELETE FROM photo_changes WHERE seq <= (SELECT MAX(seq) FROM photo_changes) - ?", (PHASH_CHANGES_KEEP,))
+        db.commit()
 
-    db.close()
+        if album_id:
+            count = db.execute("SELECT COUNT(*) as cnt FROM photos WHERE album_id=?", (album_id,)).fetchone()["cnt"]
+            if count == 1:
+                db.execute("UPDATE albums SET cover_url=? WHERE id=?", (f"/api/vault/photo/{filename}", album_id))
+                db.commit()
+    if not is_video:
+        schedule_photo_hashes(photo_id, filename)
     return {
         "id": photo_id,
         "filename": filename,
@@ -1239,6 +3204,10 @@ async def upload_photo(file: UploadFile = File(...), album_id: str = None, user:
         "duplicate_of": duplicate_of
     }
 
+@app.post("/api/vault/upload")
+async def upload_photo(file: UploadFile = File(...), album_id: str = None, user: dict = Depends(get_current_user)):
+    return await run_media(_store_uploaded_photo, file, album_id, user["id"])
+
 @app.get("/api/vault/photo/{filename}")
 def get_photo(filename: str):
     path = VAULT_DIR / filename
@@ -1266,59 +3235,50 @@ def resize_photo(filename: str, width: int, height: int):
     resized.save(path)
     return {"ok": True, "url": f"/api/vault/photo/{filename}"}
 
-@app.put("/api/vault/photo/{photo_id}/replace")
-async def replace_photo(photo_id: str, file: UploadFile = File(...)):
-    db = get_db()
-    row = db.execute("SELECT * FROM photos WHERE id=?", (photo_id,)).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Photo introuvable")
-
-    old_filename = row["filename"]
-    old_thumb = dict(row).get("thumbnail_filename")
-    album_id = row["album_id"]
-    created_at = row["created_at"]
-
-    old_path = VAULT_DIR / old_filename
-    if old_path.exists():
-        old_path.unlink()
-    if old_thumb:
-        old_thumb_path = VAULT_DIR / old_thumb
-        if old_thumb_path.exists():
-            old_thumb_path.unlink()
-
-    ext = Path(file.filename).suffix.lower() or ".jpg"
-    new_filename = f"{photo_id}_{int(datetime.utcnow().timestamp())}{ext}"
-    new_path = VAULT_DIR / new_filename
-    with open(new_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
-
-    thumbnail_filename = None
-    phash_val = None
-    try:
-        img = Image.open(new_path)
-        phash_val = str(imagehash.phash(img)) if imagehash else None
-        img.thumbnail((500, 500))
-        thumbnail_filename = f"thumb_{photo_id}_{int(datetime.utcnow().timestamp())}.webp"
-        thumb_dest = VAULT_DIR / thumbnail_filename
-        img.save(thumb_dest, format="WEBP", quality=80)
-    except Exception:
-        pass
+def _replace_photo_file(photo_id: str, file: UploadFile):
+    with db_session() as db:
+        row = db.execute("SELECT * FROM photos WHERE id=?", (photo_id,)).fetchone()
+        if not row:
+            raise HTTPException(404, "Photo introuvable")
+
+        old_filename = row["filename"]
+        old_thumb = dict(row).get("thumbnail_filename")
+        album_id = row["album_id"]
+        created_at = row["created_at"]
+
+        old_path = VAULT_DIR / old_filename
+        if old_path.exists():
+            old_path.unlink()
+        if old_thumb:
+            old_thumb_path = VAULT_DIR / old_thumb
+            if old_thumb_path.exists():
+                old_thumb_path.unlink()
+
+        ext = Path(file.filename).suffix.lower() or ".jpg"
+        new_filename = f"{photo_id}_{int(datetime.utcnow().timestamp())}{ext}"
+        new_path = VAULT_DIR / new_filename
+        with open(new_path, "wb") as f:
+            shutil.copyfileobj(file.file, f)
+        metric_inc("upload_bytes_total", new_path.stat().st_size, kind="photo")
+
+        phash_val, thumbnail_filename = process_photo_image(
+            new_path, f"thumb_{photo_id}_{int(datetime.utcnow().timestamp())}.webp"
+        )
 
-    db.execute(
-        "UPDATE photos SET filename=?, thumbnail_filename=?, phash=? WHERE id=?",
-        (new_filename, thumbnail_filename, phash_val, photo_id)
-    )
+        db.execute(
+            "UPDATE photos SET filename=?, thumbnail_filename=?, phash=? WHERE id=?",
+            (new_filename, thumbnail_filename, phash_val, photo_id)
+        )
 
-    if album_id:
-        old_url = f"/api/vault/photo/{old_filename}"
-        album_row = db.execute("SELECT cover_url FROM albums WHERE id=?", (album_id,)).fetchone()
-        if album_row and album_row["cover_url"] == old_url:
-            db.execute("UPDATE albums SET cover_url=? WHERE id=?",
-                       (f"/api/vault/photo/{new_filename}", album_id))
+        if album_id:
+            old_url = f"/api/vault/photo/{old_filename}"
+            album_row = db.execute("SELECT cover_url FROM albums WHERE id=?", (album_id,)).fetchone()
+            if album_row and album_row["cover_url"] == old_url:
+                db.execute("UPDATE albums SET cover_url=? WHERE id=?",
+                           (f"/api/vault/photo/{new_filename}", album_id))
 
-    db.commit()
-    db.close()
+        db.commit()
+    schedule_photo_hashes(photo_id, new_filename)
 
     thumb_url = f"/api/vault/photo/{thumbnail_filename}" if thumbnail_filename else f"/api/vault/photo/{new_filename}"
     return {
@@ -1330,25 +3290,30 @@ async def replace_photo(photo_id: str, file: UploadFile = File(...)):
         "created_at": created_at
     }
 
+@app.put("/api/vault/photo/{photo_id}/replace")
+async def replace_photo(photo_id: str, file: UploadFile = File(...)):
+    return await run_media(_replace_photo_file, photo_id, file)
+
 @app.put("/api/vault/photo/{photo_id}/move")
 def move_photo_to_album(photo_id: str, data: PhotoMoveToAlbum):
-    db = get_db()
-    db.execute("UPDATE photos SET album_id=? WHERE id=?", (data.album_id, photo_id))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        # Le propriétaire suit l'album de destination (index pHash mis à jour par trigger)
+        db.execute(
+            "UPDATE photos SET album_id=?, user_id=COALESCE((SELECT user_id FROM albums WHERE id=?), user_id) WHERE id=?",
+            (data.album_id, data.album_id, photo_id)
+        )
+        db.commit()
     return {"ok": True}
 
 @app.put("/api/vault/photo/{photo_id}/favorite")
 def toggle_favorite(photo_id: str):
-    db = get_db()
-    row = db.execute("SELECT favorite FROM photos WHERE id=?", (photo_id,)).fetchone()
-    if not row:
-        db.close()
-        raise HTTPException(404, "Photo not found")
-    new_val = 0 if (dict(row).get("favorite") or 0) else 1
-    db.execute("UPDATE photos SET favorite=? WHERE id=?", (new_val, photo_id))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        row = db.execute("SELECT favorite FROM photos WHERE id=?", (photo_id,)).fetchone()
+        if not row:
+            raise HTTPException(404, "Photo not found")
+        new_val = 0 if (dict(row).get("favorite") or 0) else 1
+        db.execute("UPDATE photos SET favorite=? WHERE id=?", (new_val, photo_id))
+        db.commit()
     return {"ok": True, "favorite": new_val == 1}
 
 @app.delete("/api/vault/photo/{filename}")
@@ -1356,29 +3321,163 @@ def delete_photo(filename: str):
     path = VAULT_DIR / filename
     if path.exists():
         path.unlink()
-    db = get_db()
-    # Also delete thumbnail
-    row = db.execute("SELECT thumbnail_filename FROM photos WHERE filename=?", (filename,)).fetchone()
-    if row and row["thumbnail_filename"]:
-        thumb_path = VAULT_DIR / row["thumbnail_filename"]
-        if thumb_path.exists():
-            thumb_path.unlink()
-    db.execute("DELETE FROM photos WHERE filename=?", (filename,))
-    db.commit()
-    db.close()
+    with db_session() as db:
+        # Also delete thumbnail
+        row = db.execute("SELECT thumbnail_filename FROM photos WHERE filename=?", (filename,)).fetchone()
+        if row and row["thumbnail_filename"]:
+            thumb_path = VAULT_DIR / row["thumbnail_filename"]
+            if thumb_path.exists():
+                thumb_path.unlink()
+        db.execute("DELETE FROM photos WHERE filename=?", (filename,))
+        db.commit()
     return {"ok": True}
 
 # ══════════════════════════════════════════════════════════════════════════════
 # VAULT — DUPLICATE SCAN (4-tier: pHash + crop_resistant + resize + CLIP)
 # ══════════════════════════════════════════════════════════════════════════════
 
-scan_progress = {}
-
 def _log(msg):
     print(f"[Doublon] {msg}", flush=True)
     sys.stdout.flush()
 
-def _run_scan(job_id: str, album_id):
+# ── Comparaison vectorisée (phase 2) ─────────────────────────────────────────
+# Hash empaquetés en uint64 (pHash: 1 mot, resize 16×16: 4 mots, segments crop: 1 mot chacun),
+# paires proches trouvées par photo_hashing.hamming_pairs (XOR + popcount NumPy par blocs),
+# tranches de lignes réparties sur le pool du scan
+SCAN_CHUNK_PAIRS = 1 << 26  # paires par tâche du pool (~0,2 s de calcul)
+
+def pack_hex_hash(value, words: int):
+    """Hash hexadécimal de 64·words bits → liste de words entiers 64 bits, None si invalide."""
+    if not value or len(value) != 16 * words:
+        return None
+    try:
+        return [int(value[k:k + 16], 16) for k in range(0, len(value), 16)]
+    except ValueError:
+        return None
+
+def hamming_pairs(words, max_distance: int, on_progress=None):
+    """
+    Toutes les paires (i, j), i < j, de lignes de words à distance ≤ max_distance: (i, j, distance).
+    Découpé en tranches de lignes de même nombre de paires; on_progress(fraction) après chacune.
+    """
+    n = len(words)
+    pairs = n * (n - 1) // 2
+    if not pairs:
+        return photo_hashing.hamming_pairs(words, max_distance)
+    parts = min(n - 1, pairs // SCAN_CHUNK_PAIRS + 1)
+    # Ligne r: n - 1 - r paires; bornes aux multiples de pairs / parts du cumul
+    cumulative = np.cumsum(np.arange(n - 1, 0, -1, dtype=np.int64))
+    bounds = np.searchsorted(cumulative, np.arange(1, parts) * pairs / parts) + 1
+    bounds = sorted({0, n - 1, *bounds.tolist()})
+    chunks = list(zip(bounds, bounds[1:]))
+    found, done = [], 0
+    for (start, stop), result in scan_pool_map(photo_hashing.hamming_pairs, chunks,
+                                                 lambda c: (words, max_distance, c[0], c[1])):
+        found.append(result)
+        done += int(cumulative[stop - 1] - (cumulative[start - 1] if start else 0))
+        if on_progress:
+            on_progress(done / pairs)
+    return tuple(np.concatenate([r[k] for r in found]) for k in range(3))
+
+def crop_candidate_pairs(crop_hex: list, max_distance: int = 12, ratio: float = 0.80, on_progress=None):
+    """
+    Paires (i, j), i < j, pouvant satisfaire are_crop_similar: assez de segments de la plus petite
+    image ont au moins un segment de l'autre à distance ≤ max_distance. Condition nécessaire
+    (l'appariement glouton d'are_crop_similar ne peut que faire moins): les survivantes sont vérifiées.
+    """
+    segment_values, segment_owner = [], []
+    segment_count = np.zeros(len(crop_hex), dtype=np.int64)
+    for index, value in enumerate(crop_hex):
+        segments = [pack_hex_hash(h, 1) for h in value.split(",")] if value else []
+        if not segments or None in segments:
+            continue
+        segment_values.extend(s[0] for s in segments)
+        segment_owner.extend([index] * len(segments))
+        segment_count[index] = len(segments)
+    if not segment_values:
+        return []
+    owner = np.array(segment_owner, dtype=np.int64)
+    seg_i, seg_j, _ = hamming_pairs(np.array(segment_values, dtype=np.uint64).reshape(-1, 1),
+                                    max_distance, on_progress)
+    # Segments rangés par image: seg_i < seg_j implique owner[seg_i] ≤ owner[seg_j]
+    keep = owner[seg_i] < owner[seg_j]
+    seg_i, seg_j = seg_i[keep], seg_j[keep]
+    if not len(seg_i):
+        return []
+    n = len(crop_hex)
+    a, b = owner[seg_i], owner[seg_j]
+    # Segments distincts de a ayant un voisin dans b, et de b ayant un voisin dans a
+    def matched_segments(segment, other, pair_key):
+        _, first = np.unique(segment * n + other, return_index=True)
+        return dict(zip(*np.unique(pair_key[first], return_counts=True)))
+    pair_key = a * n + b
+    matched_a = matched_segments(seg_i, b, pair_key)
+    matched_b = matched_segments(seg_j, a, pair_key)
+    pairs = []
+    for key in matched_a.keys() | matched_b.keys():
+        i, j = divmod(int(key), n)
+        small, matched = (i, matched_a.get(key, 0)) if segment_count[i] <= segment_count[j] else (j, matched_b.get(key, 0))
+        if matched >= max(1, int(segment_count[small] * ratio)):
+            pairs.append((i, j))
+    return pairs
+
+def refresh_photo_hashes(photos: list[dict], job: Job, percent_span: int) -> dict:
+    """
+    {photo_id: (crop_hash, resize_hash)} en hexadécimal. Repris de photo_hashes si la version
+    du fichier n'a pas changé, sinon calculés par le pool et enregistrés au fil de l'eau.
+    Progression du job (scanned, hashed, reused, failed) et percent de 0 à percent_span.
+    Une image illisible compte dans failed, sans interrompre le job.
+    """
+    with db_session() as db:
+        stored = {
+            row["photo_id"]: row for row in db.execute(
+                "SELECT * FROM photo_hashes WHERE photo_id IN (SELECT value FROM json_each(?))",
+                (json.dumps([p["id"] for p in photos]),)
+            ).fetchall()
+        }
+        hashes = {}
+        todo = []
+        job["hashed"] = job["reused"] = job["failed"] = 0
+        for p in photos:
+            version = photo_file_version(VAULT_DIR / p["filename"])
+            row = stored.get(p["id"])
+            if version is None:
+                job["failed"] += 1
+            elif row is not None and row["file_version"] == version:
+                hashes[p["id"]] = (row["crop_hash"], row["resize_hash"])
+                job["reused"] += 1
+                metric_inc("scan_photos_reused_total")
+            else:
+                todo.append(p)
+        total = len(photos)
+        job["scanned"] = total - len(todo)
+        job["percent"] = min(percent_span, int(job["scanned"] / total * percent_span)) if total else percent_span
+        job.save(db=db)
+
+        for p, result in iter_photo_hashes(todo):
+            record_hash_timings(result)
+            if result["error"]:
+                job["failed"] += 1
+                _log(f"hash {p['filename']}: {result['error']}")
+            if result["version"] is not None:
+                try:
+                    save_photo_hashes(db, p["id"], result["version"], result["crop_hash"], result["resize_hash"])
+                    if result["phash"] and not p.get("phash"):
+                        db.execute("UPDATE photos SET phash=? WHERE id=? AND (phash IS NULL OR phash='')",
+                                   (result["phash"], p["id"]))
+                        p["phash"] = result["phash"]
+                    db.commit()
+                except sqlite3.IntegrityError:
+                    db.rollback()  # photo supprimée pendant le scan
+                hashes[p["id"]] = (result["crop_hash"], result["resize_hash"])
+                job["hashed"] += 1
+                metric_inc("scan_photos_hashed_total")
+            job["scanned"] += 1
+            job["percent"] = min(percent_span, int(job["scanned"] / total * percent_span))
+            job.save(db=db)
+    return hashes
+
+def _run_scan(job: Job, album_id):
     """
     3-tier duplicate scan (CLIP désactivé — regroupait des photos sémantiquement
     similaires, pas des vrais doublons, ex. 68 photos du même événement):
@@ -1386,105 +3485,99 @@ def _run_scan(job_id: str, album_id):
       2. crop_resistant  (30% segments, diff≤10) → crops légers à moyens (ex. 40%)
       3. resize pHash    (threshold ≤ 10) → resizes (était 18, trop permissif)
     """
+    scan_started = time.perf_counter()
     try:
         _log("A: _run_scan démarré")
-        db = get_db()
-        if album_id:
-            rows = db.execute("SELECT * FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchall()
-        else:
-            rows = db.execute("SELECT * FROM photos WHERE media_type='image'").fetchall()
-        db.close()
+        with db_session() as db:
+            if album_id:
+                rows = db.execute("SELECT * FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchall()
+            else:
+                rows = db.execute("SELECT * FROM photos WHERE media_type='image'").fetchall()
         photos = [dict(r) for r in rows]
         total = len(photos)
-        scan_progress[job_id]["total"] = total
+        job["total"] = total
         _log(f"B: total={total} photos, imagehash={'OK' if imagehash else 'NON'}")
 
         if total < 2:
-            scan_progress[job_id].update(done=True, groups=[], scanned=total, percent=100)
+            job.update(done=True, groups=[], scanned=total, percent=100)
+            metric_inc("scan_jobs_total", status="done")
             return
 
         # ── Phase 1: Compute all hashes (0-30%) ─────────────────────────────
-        _log("C: calcul des hash (phash + crop + resize)...")
-        crop_cache = {}
-        resize_cache = {}
-
-        for i, p in enumerate(photos):
-            path = VAULT_DIR / p["filename"]
-            if path.exists():
-                if imagehash:
-                    ch = compute_crop_hash(path)
-                    if ch is not None:
-                        crop_cache[p["id"]] = ch
-                    rh = compute_resize_hash(path)
-                    if rh is not None:
-                        resize_cache[p["id"]] = rh
-                # CLIP désactivé: regroupait des photos sémantiquement similaires (ex. 68 photos du même événement)
-
-            scan_progress[job_id]["scanned"] = i + 1
-            scan_progress[job_id]["percent"] = min(30, int((i + 1) / total * 30))
-
-        _log(f"D: crop_cache={len(crop_cache)} resize_cache={len(resize_cache)}")
+        # Hash repris de photo_hashes si la version du fichier n'a pas changé, sinon calculés
+        # en parallèle (SCAN_HASH_WORKERS processus) et enregistrés
+        _log(f"C: calcul des hash (phash + crop + resize), {SCAN_HASH_WORKERS} worker(s)...")
+        stored = refresh_photo_hashes(photos, job, 30) if imagehash else {}
+        crop_hex = [stored.get(p["id"], (None, None))[0] for p in photos]
+        resize_hex = [stored.get(p["id"], (None, None))[1] for p in photos]
+        # CLIP désactivé: regroupait des photos sémantiquement similaires (ex. 68 photos du même événement)
+        job.update(scanned=total, percent=30)
+
+        _log(f"D: crop={sum(1 for h in crop_hex if h)} resize={sum(1 for h in resize_hex if h)} "
+             f"(calculés={job['hashed']}, repris={job['reused']}, échecs={job['failed']})")
 
         # ── Phase 2: Compare all pairs (30-100%) ────────────────────────────
-        total_pairs = total * (total - 1) // 2 if total > 1 else 0
+        # Paires candidates en bloc (XOR + popcount vectorisés), puis regroupement glouton:
+        # chaque photo non groupée prend, dans l'ordre, ses voisines encore libres
+        total_pairs = total * (total - 1) // 2
         _log(f"E: comparaison de {total_pairs} paires...")
-        pairs_done = 0
-        used = set()
-        groups = []
         MAX_GROUP_SIZE = 12  # sécurité: évite les méga-groupes (ex. 68 photos) en cas de seuil trop permissif
+        candidates = {}  # (i, j) → raison; None = crop à confirmer par are_crop_similar
+
+        def stage(low, high):
+            def on_progress(fraction):
+                job["percent"] = min(99, low + int(fraction * (high - low)))
+                job.save()
+            return on_progress
+
+        def add_pairs(hex_values, words, max_distance, label, on_progress):
+            packed = [pack_hex_hash(h, words) for h in hex_values]
+            index = np.array([k for k, v in enumerate(packed) if v is not None], dtype=np.int64)
+            if len(index) < 2:
+                return
+            values = np.array([packed[k] for k in index], dtype=np.uint64).reshape(-1, words)
+            rows, cols, distance = hamming_pairs(values, max_distance, on_progress)
+            for i, j, d in zip(index[rows].tolist(), index[cols].tolist(), distance.tolist()):
+                candidates.setdefault((i, j), f"{label}(diff={d})")
+
+        # Tier 1: pHash exact (stored in DB), threshold ≤ 5
+        add_pairs([p.get("phash") for p in photos], 1, 5, "phash", stage(30, 45))
+        # Tier 3: resize hash 16×16, threshold ≤ 10
+        add_pairs(resize_hex, 4, 10, "resize", stage(45, 60))
+        # Tier 2: crop_resistant_hash, préfiltre vectorisé puis vérification exacte au regroupement
+        for pair in crop_candidate_pairs(crop_hex, on_progress=stage(60, 90)):
+            candidates.setdefault(pair, None)
+        metric_inc("scan_pairs_compared_total", total_pairs)
+
+        neighbours = {}
+        for (i, j), reason in sorted(candidates.items()):
+            neighbours.setdefault(i, []).append((j, reason))
+        crop_cache = {}
+        def crop_hash(k):
+            if k not in crop_cache:
+                crop_cache[k] = imagehash.hex_to_multihash(crop_hex[k])
+            return crop_cache[k]
 
+        used = set()
+        groups = []
         for i, p1 in enumerate(photos):
-            if p1["id"] in used:
+            if i in used:
                 continue
             group = [p1]
-            used.add(p1["id"])
-
-            for j in range(i + 1, len(photos)):
+            used.add(i)
+            for j, match_reason in neighbours.get(i, ()):
                 if len(group) >= MAX_GROUP_SIZE:
                     break
-                p2 = photos[j]
-                if p2["id"] in used:
+                if j in used:
                     continue
-
-                similar = False
-                match_reason = ""
-
-                # Tier 1: pHash exact (stored in DB)
-                if not similar and p1.get("phash") and p2.get("phash"):
-                    try:
-                        diff = imagehash.hex_to_hash(p1["phash"]) - imagehash.hex_to_hash(p2["phash"])
-                        if diff <= 5:
-                            similar = True
-                            match_reason = f"phash(diff={diff})"
-                    except Exception:
-                        pass
-
-                # Tier 2: crop_resistant_hash (segment matching)
-                if not similar and p1["id"] in crop_cache and p2["id"] in crop_cache:
-                    if are_crop_similar(crop_cache[p1["id"]], crop_cache[p2["id"]]):
-                        similar = True
-                        match_reason = "crop_resistant"
-
-                # Tier 3: resize hash
-                if not similar and p1["id"] in resize_cache and p2["id"] in resize_cache:
-                    try:
-                        diff = resize_cache[p1["id"]] - resize_cache[p2["id"]]
-                        if diff <= 10:
-                            similar = True
-                            match_reason = f"resize(diff={diff})"
-                    except Exception:
-                        pass
-
-                if similar:
-                    group.append(p2)
-                    used.add(p2["id"])
-                    if len(group) == 2:
-                        _log(f"  MATCH {match_reason}: {p1.get('filename')} ~ {p2.get('filename')}")
-
-                pairs_done += 1
-                if pairs_done % 500 == 0:
-                    pct = 30 + int(pairs_done / total_pairs * 70) if total_pairs else 100
-                    scan_progress[job_id]["percent"] = min(99, pct)
+                if match_reason is None:
+                    if not are_crop_similar(crop_hash(i), crop_hash(j)):
+                        continue
+                    match_reason = "crop_resistant"
+                group.append(photos[j])
+                used.add(j)
+                if len(group) == 2:
+                    _log(f"  MATCH {match_reason}: {p1.get('filename')} ~ {photos[j].get('filename')}")
 
             if len(group) > 1:
                 for g in group:
@@ -1494,56 +3587,116 @@ def _run_scan(job_id: str, album_id):
                 groups.append(group)
 
         _log(f"F: terminé. groupes={len(groups)} (total photos en doublon={sum(len(g) for g in groups)})")
-        scan_progress[job_id].update(done=True, groups=groups, scanned=total, percent=100)
+        job.update(done=True, groups=groups, scanned=total, percent=100)
+        metric_inc("scan_jobs_total", status="done")
     except Exception as e:
         _log(f"Z: ERREUR {e}")
         import traceback
         _log(traceback.format_exc())
-        scan_progress[job_id]["error"] = str(e)
-        scan_progress[job_id]["done"] = True
+        job["error"] = str(e)
+        job["done"] = True
+        metric_inc("scan_jobs_total", status="error")
+    finally:
+        metric_inc("scan_duration_seconds_total", time.perf_counter() - scan_started)
+
+JOB_RUNNERS["scan"] = _run_scan
 
 @app.post("/api/vault/scan-duplicates")
 def start_scan(album_id: str = None):
-    db = get_db()
-    if album_id:
-        total = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
-    else:
-        total = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
-    db.close()
-    job_id = str(uuid.uuid4())
-    scan_progress[job_id] = {"scanned": 0, "total": total, "percent": 0, "done": False, "groups": [], "error": None}
-    threading.Thread(target=_run_scan, args=(job_id, album_id), daemon=True).start()
+    with db_session() as db:
+        if album_id:
+            total = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
+        else:
+            total = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
+    job_id = create_job("scan", {"album_id": album_id},
+                        {"scanned": 0, "total": total, "percent": 0, "done": False, "groups": [], "error": None})
     return {"job_id": job_id, "total": total}
 
 @app.get("/api/vault/scan-duplicates/status")
 def scan_status(job_id: str):
-    if job_id not in scan_progress:
+    state = get_job_state(job_id, "scan")
+    if state is None:
+        raise HTTPException(404, "Job not found")
+    return state
+
+# ── Backfill des hash persistés (bibliothèques existantes) ──────────────────
+# Lancé au démarrage s'il manque des hash (TOUTIENOTES_HASH_BACKFILL=0 pour le désactiver),
+# sous un id fixe: un seul backfill à la fois, quel que soit le nombre de workers.
+PHOTO_HASH_BACKFILL = os.environ.get("TOUTIENOTES_HASH_BACKFILL", "1") == "1"
+PHOTO_HASH_BACKFILL_JOB_ID = "photo-hashes-backfill"
+
+def _run_photo_hash_backfill(job: Job):
+    with db_session() as db:
+        photos = db.execute("SELECT id, filename, phash FROM photos WHERE media_type='image' ORDER BY created_at").fetchall()
+    job["total"] = len(photos)
+    if photos and imagehash:
+        refresh_photo_hashes([dict(p) for p in photos], job, 99)
+    job.update(done=True, percent=100)
+
+JOB_RUNNERS["photo_hashes"] = _run_photo_hash_backfill
+
+def enqueue_photo_hash_backfill() -> bool:
+    state = {"scanned": 0, "total": 0, "failed": 0, "percent": 0, "done": False, "error": None}
+    with db_session() as db:
+        cur = db.execute(
+            """
+            INSERT INTO jobs (id, kind, params, status, state, created_at) VALUES (?, 'photo_hashes', '{}', 'queued', ?, ?)
+            ON CONFLICT(id) DO UPDATE SET status='queued', state=excluded.state, worker=NULL, heartbeat_at=NULL
+            WHERE jobs.status IN ('done', 'error')
+            """,
+            (PHOTO_HASH_BACKFILL_JOB_ID, json.dumps(state), datetime.utcnow().isoformat())
+        )
+        db.commit()
+    if cur.rowcount:
+        dispatch_job(PHOTO_HASH_BACKFILL_JOB_ID)
+    return bool(cur.rowcount)
+
+@app.on_event("startup")
+def schedule_photo_hash_backfill():
+    if not PHOTO_HASH_BACKFILL:
+        return
+    with db_session() as db:
+        missing = db.execute(
+            """
+            SELECT COUNT(*) FROM photos p LEFT JOIN photo_hashes h ON h.photo_id = p.id
+            WHERE p.media_type='image' AND h.photo_id IS NULL
+            """
+        ).fetchone()[0]
+    if missing:
+        enqueue_photo_hash_backfill()
+
+@app.post("/api/vault/photo-hashes/backfill")
+def start_photo_hash_backfill(user: dict = Depends(require_admin)):
+    started = enqueue_photo_hash_backfill()
+    return {"job_id": PHOTO_HASH_BACKFILL_JOB_ID, "started": started}
+
+@app.get("/api/vault/photo-hashes/backfill/status")
+def photo_hash_backfill_status(user: dict = Depends(require_admin)):
+    state = get_job_state(PHOTO_HASH_BACKFILL_JOB_ID, "photo_hashes")
+    if state is None:
         raise HTTPException(404, "Job not found")
-    return scan_progress[job_id]
+    return state
 
 @app.get("/api/vault/photo-count")
 def photo_count(album_id: str = None):
-    db = get_db()
-    if album_id:
-        n = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
-    else:
-        n = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
-    db.close()
+    with db_session() as db:
+        if album_id:
+            n = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
+        else:
+            n = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
     return {"count": n}
 
 @app.post("/api/vault/scan-duplicates-sync")
 def scan_duplicates_sync(album_id: str = None):
     """Version synchrone: une seule requête, retourne le résultat complet."""
     _log("A: scan-duplicates-sync appelé")
-    db = get_db()
-    if album_id:
-        total = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
-    else:
-        total = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
-    db.close()
-    scan_progress["_sync"] = {"scanned": 0, "total": total, "percent": 0, "done": False, "groups": [], "error": None}
-    _run_scan("_sync", album_id)
-    s = scan_progress.pop("_sync", {})
+    with db_session() as db:
+        if album_id:
+            total = db.execute("SELECT COUNT(*) FROM photos WHERE album_id=? AND media_type='image'", (album_id,)).fetchone()[0]
+        else:
+            total = db.execute("SELECT COUNT(*) FROM photos WHERE media_type='image'").fetchone()[0]
+    s = Job(None, {"scanned": 0, "total": total, "percent": 0, "done": False, "groups": [], "error": None})
+    _run_scan(s, album_id)
     return {"groups": s.get("groups", []), "scanned": s.get("scanned", 0)}
 
 # ── Static files ───────────────────────────────────────────────────────────────
@@ -0,0 +1,108 @@
+"""
+Calcul et comparaison des hash de photos, partagés par main.py et les processus du scan de doublons.
+
+Ce module doit rester importable sans effet de bord (pas d'accès base, pas d'app FastAPI):
+les workers du ProcessPoolExecutor (contexte spawn) l'importent seul pour exécuter
+hash_photo_file et hamming_pairs.
+"""
+import os, time
+from pathlib import Path
+import numpy as np
+from PIL import Image
+import imagehash
+
+def file_version(path) -> str | None:
+    """Version du fichier: nom, taille, mtime. Change après un remplacement, un crop ou un resize."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{Path(path).name}:{st.st_size}:{st.st_mtime_ns}"
+
+def phash(img):
+    return imagehash.phash(img)
+
+def crop_hash(img):
+    return imagehash.crop_resistant_hash(img, hash_func=imagehash.phash)
+
+def resize_hash(img):
+    return imagehash.phash(img.resize((128, 128)).convert("L"), hash_size=16)
+
+def hash_photo_file(path: str) -> dict:
+    """
+    Décode l'image une seule fois et calcule pHash, crop-resistant hash et resize hash (hexadécimal).
+    Ne lève jamais: un fichier illisible donne des hash None et le message dans "error".
+    """
+    result = {"version": file_version(path), "phash": None, "crop_hash": None, "resize_hash": None,
+              "error": None, "timings": {}}
+    if result["version"] is None:
+        result["error"] = "fichier introuvable"
+        return result
+    try:
+        img = Image.open(path)
+        img.load()
+    except Exception as e:
+        result["error"] = f"décodage: {e}"
+        return result
+    for name, func in (("phash", phash), ("crop_hash", crop_hash), ("resize_hash", resize_hash)):
+        started = time.perf_counter()
+        try:
+            result[name] = str(func(img))
+        except Exception as e:
+            result["error"] = f"{name}: {e}"
+        result["timings"][name] = time.perf_counter() - started
+    return result
+
+# ── Distances de Hamming vectorisées ─────────────────────────────────────────
+BLOCK_ELEMENTS = 1 << 20  # paires par bloc de lignes: buffers de ~8 Mo, réutilisés
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def popcount64(values, out=None):
+    """Nombre de bits à 1 de chaque uint64 (np.bitwise_count depuis NumPy 2.0, table 8 bits sinon)."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values, out=out)
+    bytes_ = np.ascontiguousarray(values).view(np.uint8).reshape(*values.shape, 8)
+    return _POPCOUNT_TABLE[bytes_].sum(axis=-1, dtype=np.uint8, out=out)
+
+def hamming_pairs(words, max_distance: int, start: int = 0, stop: int | None = None):
+    """
+    Paires (i, j), start ≤ i < stop et i < j, des lignes de words (tableau (n, k) uint64, un hash
+    de 64·k bits par ligne) à distance de Hamming ≤ max_distance. XOR + popcount par blocs de
+    lignes contre les colonnes suivantes (triangle supérieur). Retourne (i, j, distance).
+    """
+    n, k = words.shape
+    stop = n - 1 if stop is None else min(stop, n - 1)
+    block = max(1, BLOCK_ELEMENTS // max(1, n))
+    capacity = block * n
+    xor = np.empty(capacity, dtype=np.uint64)
+    bits = np.empty(capacity, dtype=np.uint8)
+    total = np.empty(capacity, dtype=np.uint16)
+    mask = np.empty(capacity, dtype=bool)
+    found_i, found_j, found_d = [], [], []
+    for row in range(start, stop, block):
+        end = min(stop, row + block)
+        shape = (end - row, n - row - 1)
+        size = shape[0] * shape[1]
+        x, b, m = (buffer[:size].reshape(shape) for buffer in (xor, bits, mask))
+        distance = b if k == 1 else total[:size].reshape(shape)
+        for w in range(k):
+            np.bitwise_xor(words[row:end, w, None], words[None, row + 1:, w], out=x)
+            popcount64(x, out=b)
+            if k > 1 and w == 0:
+                np.copyto(distance, b)
+            elif k > 1:
+                np.add(distance, b, out=distance)
+        np.less_equal(distance, max_distance, out=m)
+        # Colonne c = ligne row + 1 + c: sous la diagonale du bloc, j ≤ i (déjà vu ou soi-même)
+        m[np.tril_indices(shape[0], -1, shape[1])] = False
+        if not m.any():
+            continue
+        flat = np.flatnonzero(m)
+        rows, cols = np.divmod(flat, shape[1])
+        found_i.append(rows + row)
+        found_j.append(cols + row + 1)
+        found_d.append(distance.reshape(-1)[flat].astype(np.uint16))
+    if not found_i:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.uint16)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
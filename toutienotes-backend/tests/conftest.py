@@ -0,0 +1,32 @@
+"""
+Tests du backend: main.py est importé une seule fois sur un répertoire de données temporaire,
+avec la trace SQL activée (en-tête X-Debug-Trace: 1 → nombre de requêtes de la requête HTTP).
+"""
+import os, shutil, sys, tempfile, uuid
+from pathlib import Path
+
+DATA_DIR = tempfile.mkdtemp(prefix="toutienotes-tests-")
+os.environ["TOUTIENOTES_DATA_DIR"] = DATA_DIR
+os.environ.pop("TOUTIENOTES_LOCAL_DB", None)
+os.environ["TOUTIENOTES_TRACE"] = "1"
+os.environ["TOUTIENOTES_WARMUP"] = "0"
+os.environ["TOUTIENOTES_HASH_BACKFILL"] = "0"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pytest
+from fastapi.testclient import TestClient
+import main
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as client:
+        yield client
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+@pytest.fixture
+def new_user(client):
+    """Crée un compte vide et retourne ses en-têtes d'authentification."""
+    def create():
+        response = client.post("/api/auth/register", json={"username": f"u{uuid.uuid4().hex[:10]}", "password": "secret"})
+        return {"Authorization": f"Bearer {response.json()['token']}"}
+    return create
@@ -0,0 +1,21 @@
+"""Routes d'administration et jobs globaux: refusées aux anonymes (401) et aux comptes hors TOUTIENOTES_ADMIN_USERS (403)."""
+import pytest
+
+ADMIN_ROUTES = [
+    ("get", "/api/admin/jobs"),
+    ("get", "/api/admin/startup"),
+    ("get", "/api/admin/db/pool"),
+    ("get", "/api/admin/auth/cache"),
+    ("get", "/api/admin/traces"),
+    ("get", "/api/admin/db/snapshot"),
+    ("post", "/api/admin/db/snapshot"),
+    ("post", "/api/admin/notes/recompress"),
+    ("get", "/api/admin/notes/recompress/status?job_id=x"),
+    ("post", "/api/vault/photo-hashes/backfill"),
+    ("get", "/api/vault/photo-hashes/backfill/status"),
+]
+
+@pytest.mark.parametrize("method, url", ADMIN_ROUTES)
+def test_admin_routes_require_admin(client, new_user, method, url):
+    assert getattr(client, method)(url).status_code == 401
+    assert getattr(client, method)(url, headers=new_user()).status_code == 403
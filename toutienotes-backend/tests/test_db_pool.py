@@ -0,0 +1,35 @@
+"""Une exception au milieu d'un endpoint rend quand même la connexion au pool de son thread."""
+import shutil
+import pytest
+import main
+
+def pool_in_use():
+    with main._db_pool_lock:
+        return main.db_pool_stats["in_use"]
+
+def test_connection_released_after_http_error(client, new_user):
+    auth = new_user()
+    note = client.post("/api/notes", json={"title": "Pièces", "content": ""}, headers=auth).json()
+    response = client.post(f"/api/notes/{note['id']}/attachments", headers=auth,
+                           files={"file": ("vide.txt", b"", "text/plain")})
+    assert response.status_code == 400
+    assert client.post("/api/auth/login", json={"username": "absent", "password": "x"}).status_code == 401
+    assert pool_in_use() == 0
+
+def test_connection_released_after_unexpected_error(client, new_user, monkeypatch):
+    auth = new_user()
+    note = client.post("/api/notes", json={"title": "Pièces", "content": ""}, headers=auth).json()
+    def broken_copy(*args, **kwargs):
+        raise OSError("disque plein")
+    monkeypatch.setattr(shutil, "copyfileobj", broken_copy)
+    with pytest.raises(OSError):
+        client.post(f"/api/notes/{note['id']}/attachments", headers=auth,
+                    files={"file": ("a.txt", b"contenu", "text/plain")})
+    monkeypatch.undo()
+    assert pool_in_use() == 0
+    with main._db_pool_lock:
+        overflow = main.db_pool_stats["overflow"]
+    for _ in range(5):
+        assert client.get("/api/notes", headers=auth).status_code == 200
+    with main._db_pool_lock:
+        assert main.db_pool_stats["overflow"] == overflow
@@ -0,0 +1,85 @@
+"""Jobs: un job en cours dans ce processus n'est jamais exécuté deux fois, et sa progression passe par la connexion du runner."""
+import json
+import sqlite3
+import threading
+import time
+import main
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+def job_row(job_id):
+    with main.db_session() as db:
+        return db.execute("SELECT status, heartbeat_at FROM jobs WHERE id=?", (job_id,)).fetchone()
+
+def test_heartbeat_survives_locked_database(monkeypatch):
+    job_id = main.create_job("test_absent", {}, {})
+    assert wait_for(lambda: job_row(job_id)["status"] == "error")
+    with main.db_session() as db:
+        db.execute("UPDATE jobs SET status='running', worker=?, heartbeat_at=0 WHERE id=?", (main.WORKER_ID, job_id))
+        db.commit()
+    real_session = main.db_session
+    calls = []
+    def flaky_session():
+        calls.append(1)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError("database is locked")
+        return real_session()
+    monkeypatch.setattr(main, "JOB_HEARTBEAT_SECONDS", 0.01)
+    monkeypatch.setattr(main, "db_session", flaky_session)
+    stop = threading.Event()
+    beat = threading.Thread(target=main._job_heartbeat, args=(job_id, stop), daemon=True)
+    beat.start()
+    try:
+        assert wait_for(lambda: len(calls) >= 2 and job_row(job_id)["heartbeat_at"] > 0)
+        assert beat.is_alive()
+    finally:
+        stop.set()
+        beat.join()
+
+def test_stale_job_not_rerun_locally(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    runs = []
+    def blocking_runner(job):
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        job.update(done=True)
+    monkeypatch.setitem(main.JOB_RUNNERS, "test_bloquant", blocking_runner)
+    job_id = main.create_job("test_bloquant", {}, {"done": False})
+    try:
+        assert started.wait(5)
+        with main.db_session() as db:
+            db.execute("UPDATE jobs SET heartbeat_at=0 WHERE id=?", (job_id,))
+            db.commit()
+        assert main.run_job(job_id) is False
+        main.get_job_state(job_id, "test_bloquant")
+    finally:
+        release.set()
+    assert wait_for(lambda: job_row(job_id)["status"] == "done")
+    assert runs == [1]
+
+def test_job_progress_uses_runner_connection():
+    with main.db_session() as db:
+        for i in range(3):
+            db.execute("INSERT INTO notes (id, title, content, updated_at, created_at, user_id) VALUES (?,?,?,?,?,?)",
+                       (f"brut-{i}", "Brut", "x" * (main.NOTE_COMPRESS_THRESHOLD * 2), "", "", "compte-test"))
+        db.execute(
+            "INSERT INTO jobs (id, kind, params, status, state, created_at) VALUES ('recompression-test', 'recompress', ?, 'queued', ?, '')",
+            (json.dumps({"vacuum": False}), json.dumps({
+                "total": 3, "scanned": 0, "compressed": 0, "percent": 0, "bytes_before": 0, "bytes_after": 0,
+                "saved_bytes": 0, "db_size_before": None, "db_size_after": None, "done": False, "error": None,
+            }))
+        )
+        db.commit()
+    with main._db_pool_lock:
+        overflow = main.db_pool_stats["overflow"]
+    assert main.run_job("recompression-test")
+    with main._db_pool_lock:
+        assert main.db_pool_stats["overflow"] == overflow
+    assert job_row("recompression-test")["status"] == "done"
@@ -0,0 +1,22 @@
+"""Une suppression refusée (note d'un autre compte) ne touche à rien de ce qui appartient au propriétaire."""
+import main
+
+def test_foreign_delete_keeps_revisions(client, new_user, monkeypatch):
+    monkeypatch.setattr(main, "REVISION_COALESCE_SECONDS", 0)
+    owner, other = new_user(), new_user()
+    note = client.post("/api/notes", json={"title": "Journal", "content": "v1"}, headers=owner).json()
+    client.put(f"/api/notes/{note['id']}", json={"title": "Journal", "content": "v2"}, headers=owner)
+    revisions = client.get(f"/api/notes/{note['id']}/revisions", headers=owner).json()
+    assert len(revisions) == 2
+
+    assert client.delete(f"/api/notes/{note['id']}", headers=other).status_code == 404
+    assert client.get(f"/api/notes/{note['id']}/revisions", headers=owner).json() == revisions
+
+def test_foreign_delete_keeps_pending_autosave(client, new_user):
+    owner, other = new_user(), new_user()
+    note = client.post("/api/notes", json={"title": "Brouillon", "content": "v1"}, headers=owner).json()
+    client.put(f"/api/notes/{note['id']}", json={"title": "Brouillon", "content": "v2"}, headers=owner)
+    assert main.get_pending_note(note["id"]) is not None
+
+    assert client.delete(f"/api/notes/{note['id']}", headers=other).status_code == 404
+    assert client.get(f"/api/notes/{note['id']}", headers=owner).json()["content"] == "v2"
@@ -0,0 +1,51 @@
+"""Les endpoints de liste chargent les tags en une requête: nombre de requêtes SQL fixe, quel que soit le nombre de notes."""
+import pytest
+
+def query_count(client, auth, url, **params):
+    response = client.get(url, params=params, headers={**auth, "X-Debug-Trace": "1"})
+    assert response.status_code == 200, response.text
+    summary = dict(part.strip().split("=") for part in response.headers["x-debug-trace"].split(";"))
+    return int(summary["queries"]), response.json()
+
+def create_notes(client, auth, count, content):
+    for i in range(count):
+        response = client.post("/api/notes", json={"title": f"Note {i}", "content": content}, headers=auth)
+        assert response.status_code == 200, response.text
+
+@pytest.mark.parametrize("url, params", [
+    ("/api/notes", {}),
+    ("/api/notes", {"limit": 100}),
+    ("/api/notes/search", {"q": "carottes"}),
+])
+def test_list_query_count_is_constant(client, new_user, url, params):
+    counts = {}
+    for size in (1, 25):
+        auth = new_user()
+        create_notes(client, auth, size, "#courses #maison carottes et poireaux")
+        query_count(client, auth, url, **params)  # cache d'authentification chaud
+        counts[size], payload = query_count(client, auth, url, **params)
+        notes = payload["notes"] if isinstance(payload, dict) else payload
+        assert len(notes) == size
+        assert all(sorted(n["tags"]) == ["courses", "maison"] for n in notes)
+    assert counts[1] == counts[25]
+
+def test_backlinks_query_count_is_constant(client, new_user):
+    counts = {}
+    for size in (1, 25):
+        auth = new_user()
+        target = client.post("/api/notes", json={"title": "Cible", "content": ""}, headers=auth).json()
+        create_notes(client, auth, size, "#lien voir [[Cible]]")
+        url = f"/api/notes/{target['id']}/backlinks"
+        query_count(client, auth, url)
+        counts[size], notes = query_count(client, auth, url)
+        assert len(notes) == size and all(n["tags"] == ["lien"] for n in notes)
+    assert counts[1] == counts[25]
+
+def test_media_upload_queries_are_traced(client, new_user):
+    auth = new_user()
+    note = client.post("/api/notes", json={"title": "Pièces", "content": ""}, headers=auth).json()
+    response = client.post(f"/api/notes/{note['id']}/attachments", headers={**auth, "X-Debug-Trace": "1"},
+                           files={"file": ("a.txt", b"contenu", "text/plain")})
+    assert response.status_code == 200, response.text
+    summary = dict(part.strip().split("=") for part in response.headers["x-debug-trace"].split(";"))
+    assert int(summary["queries"]) > 0  # SQL du pool média rattaché à la requête